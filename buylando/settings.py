@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 from pathlib import Path
 
 import environ
+from django.core.exceptions import ImproperlyConfigured
 
 env = environ.Env()
 environ.Env.read_env()
@@ -42,6 +43,7 @@ INSTALLED_APPS = [
     "django.contrib.sessions",
     "django.contrib.messages",
     "django.contrib.staticfiles",
+    "django.contrib.postgres",
     # installed dependencies
     "drf_yasg",
     # project apps
@@ -95,6 +97,40 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+# the catalogue version and the build locks have to be shared by all the processes
+# (web, workers, commands), so it lives in the redis service of docker compose.
+CACHES = {"default": env.cache("CACHE_URL", "redis://cache:6379/1")}
+if not DEBUG and CACHES["default"]["BACKEND"].endswith("LocMemCache"):
+    raise ImproperlyConfigured("A per-process cache (locmemcache) can not be used in production.")
+
+CATALOGUE_CACHE_TIMEOUT = env.int("CATALOGUE_CACHE_TIMEOUT", 60 * 15)
+CATALOGUE_CACHE_LOCK_TIMEOUT = env.int("CATALOGUE_CACHE_LOCK_TIMEOUT", 10)
+
+# lower bounds of the price histogram buckets in product list facets
+PRODUCT_PRICE_BUCKETS = [0, 100, 500, 1000, 2500, 5000]
+
+PRODUCT_IMPORT_CHUNK_SIZE = env.int("PRODUCT_IMPORT_CHUNK_SIZE", 1000)
+PRODUCT_EXPORT_CHUNK_SIZE = env.int("PRODUCT_EXPORT_CHUNK_SIZE", 2000)
+
+# responsive renditions of product images, AVIF is skipped if Pillow can not encode it
+PRODUCT_IMAGE_RENDITION_WIDTHS = env.list("PRODUCT_IMAGE_RENDITION_WIDTHS", int, [320, 640, 1280])
+PRODUCT_IMAGE_RENDITION_FORMATS = env.list(
+    "PRODUCT_IMAGE_RENDITION_FORMATS", str, ["WEBP", "AVIF"]
+)
+# larger uploads are refused by the image workers (~24 MP, ~100 MB decoded)
+PRODUCT_IMAGE_MAX_PIXELS = env.int("PRODUCT_IMAGE_MAX_PIXELS", 6000 * 4000)
+# miniatures of imported products are created in tasks of this many products
+PRODUCT_IMAGE_TASK_BATCH_SIZE = env.int("PRODUCT_IMAGE_TASK_BATCH_SIZE", 50)
+
+# resumable image uploads: part files are kept outside of the media root until completed
+PRODUCT_UPLOAD_TEMP_DIR = env.str("PRODUCT_UPLOAD_TEMP_DIR", str(BASE_DIR / "uploads"))
+PRODUCT_UPLOAD_MAX_SIZE = env.int("PRODUCT_UPLOAD_MAX_SIZE", 50 * 2**20)
+PRODUCT_UPLOAD_MAX_CHUNK_SIZE = env.int("PRODUCT_UPLOAD_MAX_CHUNK_SIZE", 8 * 2**20)
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -135,6 +171,12 @@ STATIC_ROOT = BASE_DIR / "static"
 MEDIA_URL = "media/"
 MEDIA_ROOT = BASE_DIR / "media"
 
+# media files are named after their content, so they are served as immutable
+STORAGES = {
+    "default": {"BACKEND": "ecommerce.storage.ContentAddressedStorage"},
+    "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
@@ -145,6 +187,46 @@ AUTH_USER_MODEL = "core.User"
 SWAGGER_SETTINGS = {"SECURITY_DEFINITIONS": None}
 
 CELERY_BROKER_URL = env.str("CELERY_BROKER_URL", "amqp://guest@mq")
+# image processing runs on its own workers so it does not delay the emails
+CELERY_TASK_ROUTES = {
+    "ecommerce.tasks.create_image_min": {"queue": "images"},
+    "ecommerce.tasks.create_images_min": {"queue": "images"},
+}
+CELERY_BEAT_SCHEDULE = {
+    "purge-idempotency-keys": {
+        "task": "ecommerce.tasks.purge_idempotency_keys",
+        "schedule": 60 * 60,
+    },
+    "purge-outbox": {
+        "task": "ecommerce.tasks.purge_outbox",
+        "schedule": 60 * 60,
+    },
+    "send-payment-reminders": {
+        "task": "ecommerce.tasks.send_payment_reminders",
+        "schedule": 10 * 60,
+    },
+}
+
+# unpaid orders are reminded a day after their payment deadline (in seconds)
+PAYMENT_REMINDER_DELAY = env.int("PAYMENT_REMINDER_DELAY", 24 * 60 * 60)
+PAYMENT_REMINDER_BATCH_SIZE = env.int("PAYMENT_REMINDER_BATCH_SIZE", 500)
+
+# tasks written to the outbox in the request's transaction are published by relay_outbox
+OUTBOX_BATCH_SIZE = env.int("OUTBOX_BATCH_SIZE", 100)
+OUTBOX_RELAY_INTERVAL = env.float("OUTBOX_RELAY_INTERVAL", 1.0)
+# messages of these tasks are published grouped into calls of their batch variants
+OUTBOX_BATCH_TASKS = {
+    "ecommerce.tasks.send_order_email": "ecommerce.tasks.send_order_emails",
+}
+OUTBOX_TASK_BATCH_SIZE = env.int("OUTBOX_TASK_BATCH_SIZE", 50)
+# processed messages are kept for a week (in seconds)
+OUTBOX_RETENTION = env.int("OUTBOX_RETENTION", 7 * 24 * 60 * 60)
+
+# how long responses of requests with an Idempotency-Key are replayed (in seconds)
+IDEMPOTENCY_KEY_TTL = env.int("IDEMPOTENCY_KEY_TTL", 24 * 60 * 60)
 
 EMAIL_BACKEND = env.str("EMAIL_BACKEND", "django.core.mail.backends.console.EmailBackend")
 EMAIL_SENDER = env.str("EMAIL_SENDER", "seller@mail.com")
+# failed recipients are retried after 30s, 60s, 120s, ...
+EMAIL_MAX_RETRIES = env.int("EMAIL_MAX_RETRIES", 5)
+EMAIL_RETRY_BACKOFF = env.int("EMAIL_RETRY_BACKOFF", 30)
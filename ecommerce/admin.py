@@ -1,7 +1,19 @@
 from django.contrib import admin
 from django.contrib.admin import ModelAdmin, TabularInline
+from django.db import transaction
+from django.utils.translation import gettext_lazy as _
 
-from .models import Order, OrderItem, Product, ProductCategory, ShippingAddress
+from .cache import bump_catalogue_version
+from .models import (
+    ImageStatus,
+    Order,
+    OrderItem,
+    PaymentStatus,
+    Product,
+    ProductCategory,
+    ShippingAddress,
+)
+from .tasks import create_image_min
 
 
 class ShippingAddressAdmin(ModelAdmin):
@@ -24,14 +36,29 @@ class ProductAdmin(ModelAdmin):
         "name",
         "category",
         "price",
+        "stock",
+        "image_min_status",
     )
-    list_filter = ("category",)
+    list_filter = ("category", "image_min_status")
     search_fields = ("name",)
+    readonly_fields = ("image_min", "image_min_status")
+    actions = ("regenerate_image_min",)
+
+    @admin.action(description=_("Regenerate miniatures of selected products"))
+    def regenerate_image_min(self, request, queryset):
+        product_ids = list(queryset.values_list("pk", flat=True))
+        queryset.update(image_min_status=ImageStatus.PENDING)
+        # update() sends no signals, the cached responses are invalidated here
+        transaction.on_commit(bump_catalogue_version)
+        for product_id in product_ids:
+            create_image_min.delay(product_id)
+        self.message_user(request, _("Miniatures queued: %d.") % len(product_ids))
 
 
 class OrderItemInline(TabularInline):
     model = OrderItem
-    fields = "product", "quantity"
+    fields = "product", "quantity", "unit_price"
+    readonly_fields = ("unit_price",)
     extra = 0
 
 
@@ -42,11 +69,41 @@ class OrderAdmin(ModelAdmin):
         "created_at",
         "payment_deadline",
         "total_price",
+        "payment_status",
     )
-    list_filter = ("user",)
+    list_filter = ("user", "payment_status")
     search_fields = ("user",)
-    readonly_fields = ("created_at",)
+    readonly_fields = ("created_at", "total_price", "reminder_sent_at")
     inlines = (OrderItemInline,)
+    actions = ("mark_paid",)
+
+    @admin.action(description=_("Mark selected orders as paid"))
+    def mark_paid(self, request, queryset):
+        # unpaid orders are the only ones reminded
+        updated = queryset.update(payment_status=PaymentStatus.PAID)
+        self.message_user(request, _("Orders marked as paid: %d.") % updated)
+
+    def save_formset(self, request, form, formset, change):
+        if formset.model is not OrderItem:
+            return super().save_formset(request, form, formset, change)
+
+        items = formset.save(commit=False)
+        for item in formset.deleted_objects:
+            item.delete()
+
+        # added items and replaced products are priced like in the API, at the current price
+        repriced = formset.new_objects + [
+            item for item, changed_fields in formset.changed_objects if "product" in changed_fields
+        ]
+        for item in items:
+            if item in repriced:
+                item.unit_price = item.product.price
+            item.save()
+        formset.save_m2m()
+
+        order = form.instance
+        order.total_price = Order.calculate_total_price(order.items.all())
+        order.save(update_fields=["total_price"])
 
 
 admin.site.register(ShippingAddress, ShippingAddressAdmin)
@@ -0,0 +1,96 @@
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db.models import Case, Count, F, FloatField, IntegerField, Q, Value, When
+from django.db.models.functions import Cast
+
+from ecommerce.models import Product, ProductCategory
+
+
+def filter_products(products, filters):
+    """
+    Applies validated ProductFilterSerializer data to the products.
+    Products are ordered by pk, or by relevance when searching with q.
+    """
+    products = products.order_by("pk")
+
+    search = filters.get("q")
+    name = filters.get("name")
+    category = filters.get("category")
+    description = filters.get("desc")
+    price = filters.get("price")
+    price_min = filters.get("price_min")
+    price_max = filters.get("price_max")
+
+    if search:
+        query = SearchQuery(search, config=Product.SEARCH_CONFIG, search_type="websearch")
+        products = (
+            # double precision ranks survive a round trip through a pagination cursor
+            products.annotate(rank=Cast(SearchRank(F("search_vector"), query), FloatField()))
+            .filter(
+                Q(search_vector=query)
+                | Q(name__icontains=search)
+                | Q(description__icontains=search)
+            )
+            .order_by("-rank", "pk")
+        )
+    if name:
+        products = products.filter(name__icontains=name)
+    if category:
+        # a subquery instead of a join lets the (category, ...) indexes be used
+        products = products.filter(
+            category__in=ProductCategory.objects.filter(name__iexact=category).values("pk")
+        )
+    if description:
+        products = products.filter(description__icontains=description)
+    if price is not None:
+        products = products.filter(price=price)
+    if price_min is not None:
+        products = products.filter(price__gte=price_min)
+    if price_max is not None:
+        products = products.filter(price__lte=price_max)
+
+    return products
+
+
+def get_product_facets(products):
+    """
+    Returns the per category counts and the price histogram of the products,
+    both computed with one query grouped by (category, price bucket).
+    """
+    bounds = settings.PRODUCT_PRICE_BUCKETS
+    price_bucket = Case(
+        *[When(price__lt=upper, then=Value(i)) for i, upper in enumerate(bounds[1:])],
+        default=Value(len(bounds) - 1),
+        output_field=IntegerField(),
+    )
+
+    rows = (
+        products.order_by()
+        .annotate(price_bucket=price_bucket)
+        .values("category_id", "category__name", "price_bucket")
+        .annotate(count=Count("pk"))
+    )
+
+    categories = {}
+    price_counts = [0] * len(bounds)
+    for row in rows:
+        category = categories.setdefault(
+            row["category_id"],
+            {"id": row["category_id"], "name": row["category__name"], "count": 0},
+        )
+        category["count"] += row["count"]
+        price_counts[row["price_bucket"]] += row["count"]
+
+    prices = [
+        {
+            "min": lower,
+            "max": bounds[i + 1] if i + 1 < len(bounds) else None,
+            "count": count,
+        }
+        for i, (lower, count) in enumerate(zip(bounds, price_counts))
+    ]
+
+    return {
+        "categories": sorted(categories.values(), key=lambda category: category["name"]),
+        "prices": prices,
+    }
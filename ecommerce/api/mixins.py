@@ -0,0 +1,230 @@
+import hashlib
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from rest_framework import exceptions, status
+from rest_framework.response import Response
+
+from ecommerce.cache import get_catalogue_state, get_or_build, make_catalogue_key
+from ecommerce.models import IdempotencyKey
+
+
+class CatalogueCacheMixin:
+    """
+    Caches list and retrieve responses under the current catalogue version.
+    The key is the absolute URL with the query parameters sorted.
+
+    Responses carry an ETag and Last-Modified that change with the catalogue version,
+    so conditional requests are answered with 304 before anything is serialized.
+    The version is read once per request, a hit costs three cache round trips.
+    """
+
+    cache_prefix = None
+    # parameters that do not change which products the validators are computed over
+    validator_ignored_params = (
+        "page",
+        "cursor",
+        "pagination",
+        "count",
+        "order",
+        "fields",
+        "expand",
+        "facets",
+    )
+
+    def get_catalogue_state(self):
+        if not hasattr(self, "_catalogue_state"):
+            self._catalogue_state = get_catalogue_state()
+        return self._catalogue_state
+
+    def get_cache_key(self, request, prefix=None, ignored_params=()):
+        params = sorted(
+            (key, value)
+            for key, values in request.GET.lists()
+            if key not in ignored_params
+            for value in values
+        )
+        return make_catalogue_key(
+            prefix or self.cache_prefix,
+            request.scheme,
+            request.get_host(),
+            request.path,
+            params,
+            version=self.get_catalogue_state()[0],
+        )
+
+    def get_validator_queryset(self):
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        if lookup_url_kwarg in self.kwargs:
+            lookup = self.kwargs[lookup_url_kwarg]
+            return self.get_queryset().filter(**{self.lookup_field: lookup})
+        return self.filter_queryset(self.get_queryset())
+
+    def get_validators(self, request):
+        """
+        Returns the (etag, last_modified) of the requested representation.
+
+        Last-Modified is the latest of the products' updated_at and of the last catalogue
+        change, which covers deleted products and products leaving the filter.
+        The ETag is derived from the URL, the catalogue version and Last-Modified.
+        The only query, Max(updated_at), is cached per filter (not per page) and version.
+        """
+
+        def build_aggregate():
+            try:
+                return (
+                    self.get_validator_queryset()
+                    .order_by()
+                    .aggregate(last_modified=Max("updated_at"))
+                )
+            except (TypeError, ValueError, ValidationError):
+                return {}  # malformed lookup, left for the view to answer with 404
+
+        key = self.get_cache_key(
+            request,
+            prefix=f"{self.cache_prefix}:validators",
+            ignored_params=self.validator_ignored_params,
+        )
+        aggregate = get_or_build(key, build_aggregate)
+        if not aggregate:
+            return None, None
+
+        version, catalogue_modified = self.get_catalogue_state()
+        modified = [aggregate["last_modified"], catalogue_modified]
+        last_modified = max((value for value in modified if value), default=None)
+
+        signature = f"{request.build_absolute_uri()}|{version}|{last_modified}"
+        etag = hashlib.md5(signature.encode("utf-8")).hexdigest()
+        return quote_etag(etag), last_modified
+
+    def _set_validators(self, response, etag, last_modified):
+        response["ETag"] = etag
+        if last_modified:
+            response["Last-Modified"] = http_date(last_modified.timestamp())
+        return response
+
+    def _get_cached_response(self, request, build):
+        etag, last_modified = self.get_validators(request)
+        if etag is None:
+            return build()
+
+        not_modified = get_conditional_response(
+            request,
+            etag=etag,
+            last_modified=last_modified and int(last_modified.timestamp()),
+        )
+        if not_modified is not None:
+            return self._set_validators(not_modified, etag, last_modified)
+
+        data = get_or_build(self.get_cache_key(request), lambda: build().data)
+        return self._set_validators(Response(data), etag, last_modified)
+
+    def list(self, request, *args, **kwargs):
+        build_list = super().list
+        return self._get_cached_response(request, lambda: build_list(request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        build_retrieve = super().retrieve
+        return self._get_cached_response(request, lambda: build_retrieve(request, *args, **kwargs))
+
+
+class SparseFieldsMixin:
+    """
+    Reads ?fields=id,name,... and ?expand=category for the read serializer, which
+    narrows both its queryset's columns and its output to them.
+    Without ?fields the full representation is returned.
+    """
+
+    def _parse_list_param(self, name, allowed):
+        values = [value.strip() for value in self.request.GET.get(name, "").split(",")]
+        values = [value for value in values if value]
+
+        unknown = [value for value in values if value not in allowed]
+        if unknown:
+            raise exceptions.ValidationError({name: [f"Unknown fields: {', '.join(unknown)}."]})
+
+        return values
+
+    def get_sparse_fieldset(self):
+        if not hasattr(self, "_sparse_fieldset"):
+            self._sparse_fieldset = {"fields": None, "expand": None}
+
+            if self.request is not None and self.request.GET.get("fields"):
+                serializer_class = self.read_serializer_class
+                self._sparse_fieldset = {
+                    "fields": self._parse_list_param("fields", serializer_class.sparse_fields),
+                    "expand": self._parse_list_param("expand", serializer_class.expandable_fields),
+                }
+
+        return self._sparse_fieldset
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if self.request is not None and self.request.method == "GET":
+            context.update(self.get_sparse_fieldset())
+        return context
+
+
+class IdempotentCreateMixin:
+    """
+    Makes create() idempotent for requests sent with an Idempotency-Key header.
+
+    The key is inserted in the same transaction as the created objects, together with
+    a fingerprint of the request and the response. Retries get the stored response
+    replayed. A concurrent duplicate blocks on the key's unique index until the first
+    request commits and is then answered with its response. If the first request fails,
+    its key is rolled back with everything else and the retry is processed normally.
+    Keys older than IDEMPOTENCY_KEY_TTL that are not purged yet are reused.
+    """
+
+    idempotency_header = "Idempotency-Key"
+
+    def get_request_fingerprint(self, request):
+        body = json.dumps(request.data, sort_keys=True, cls=DjangoJSONEncoder)
+        return hashlib.sha256(
+            f"{request.method} {request.path} {body}".encode("utf-8")
+        ).hexdigest()
+
+    def create(self, request, *args, **kwargs):
+        key = request.headers.get(self.idempotency_header)
+        if key is None:
+            return super().create(request, *args, **kwargs)
+
+        if not 0 < len(key) <= IdempotencyKey._meta.get_field("key").max_length:
+            raise exceptions.ValidationError({self.idempotency_header: ["Invalid key."]})
+
+        fingerprint = self.get_request_fingerprint(request)
+        with transaction.atomic():
+            # locked, so that concurrent requests can not both reuse an expired key
+            record, created = IdempotencyKey.objects.select_for_update().get_or_create(
+                user=request.user, key=key, defaults={"fingerprint": fingerprint}
+            )
+            expired = timezone.now() - timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL)
+            if not created and record.created_at < expired:
+                record.fingerprint, record.created_at = fingerprint, timezone.now()
+                created = True
+
+            if not created:
+                if record.fingerprint != fingerprint:
+                    return Response(
+                        {"detail": f"{self.idempotency_header} was used for a different request."},
+                        status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                    )
+                response = Response(record.response_body, status=record.response_status)
+                response["Idempotent-Replayed"] = "true"
+                return response
+
+            response = super().create(request, *args, **kwargs)
+            record.response_status = response.status_code
+            record.response_body = response.data
+            record.save()
+
+        return response
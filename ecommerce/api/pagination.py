@@ -1,5 +1,218 @@
+import datetime
+import json
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from django.db.models import Q
 from rest_framework import pagination
+from rest_framework.exceptions import NotFound
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class CursorEncoder(DjangoJSONEncoder):
+    def default(self, o):
+        # DjangoJSONEncoder truncates datetimes to milliseconds, keysets need them exact
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        return super().default(o)
+
+
+def estimate_count(queryset):
+    """
+    Returns the query planner's row estimate for the queryset.
+    Unlike COUNT(*) it does not scan the table, so the number is approximate.
+    """
+    queryset = queryset.order_by()
+    sql, params = queryset.query.sql_with_params()
+
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+        plan = cursor.fetchone()[0]
+
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    return plan[0]["Plan"]["Plan Rows"]
 
 
 class ProductPagination(pagination.PageNumberPagination):
     page_size = 10
+
+
+class KeysetPagination(pagination.BasePagination):
+    """
+    Keyset pagination following the ordering of the paginated queryset.
+    The ordering has to end with a unique field (pk) to act as a tie-breaker.
+
+    Instead of OFFSET, the next page is selected with a WHERE clause built from
+    the last row of the current one and no COUNT(*) is run.
+    """
+
+    page_size = 10
+    cursor_query_param = "cursor"
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(queryset)
+        self.value_fields = [self._get_value_field(queryset, field) for field, _ in self.ordering]
+
+        cursor = self.decode_cursor(request)
+        reverse = cursor is not None and cursor["r"]
+
+        if cursor is not None:
+            queryset = queryset.filter(self._get_keyset_filter(cursor["v"], reverse))
+        if reverse:
+            queryset = queryset.order_by(
+                *[("" if desc else "-") + field for field, desc in self.ordering]
+            )
+
+        results = list(queryset[: self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[: self.page_size]
+
+        if reverse:
+            results.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, cursor is not None
+
+        self.page = results
+        return results
+
+    def get_ordering(self, queryset):
+        """
+        Returns the queryset's ordering as a list of (field, descending) tuples.
+        Relations are compared by their column (ex. category -> category_id)
+        and pk by the primary key's column, so both work with .values() rows.
+        """
+        opts = queryset.model._meta
+        ordering = []
+        for field_name in queryset.query.order_by:
+            desc = field_name.startswith("-")
+            field = field_name.lstrip("-")
+
+            if field == "pk":
+                field = opts.pk.attname
+            else:
+                try:
+                    field = opts.get_field(field).attname
+                except FieldDoesNotExist:
+                    pass  # annotation
+
+            ordering.append((field, desc))
+
+        if not ordering or ordering[-1][0] != opts.pk.attname:
+            raise ValueError(f"{type(self).__name__} requires an ordering ending with 'pk'.")
+
+        return ordering
+
+    def _get_value_field(self, queryset, field):
+        """
+        Returns the model field the cursor values of the ordering field are converted with.
+        """
+        if field in queryset.query.annotations:
+            return queryset.query.annotations[field].output_field
+        field = queryset.model._meta.get_field(field)
+        return field.target_field if field.is_relation else field
+
+    def _get_keyset_filter(self, values, reverse):
+        """
+        (a, b, pk) > (x, y, z) expanded to:
+        a > x OR (a = x AND b > y) OR (a = x AND b = y AND pk > z)
+        with the comparison flipped for descending fields and backward pages.
+        """
+        keyset_filter = Q()
+        equal = Q()
+        for (field, desc), value in zip(self.ordering, values):
+            lookup = "lt" if desc != reverse else "gt"
+            keyset_filter |= equal & Q(**{f"{field}__{lookup}": value})
+            equal &= Q(**{field: value})
+        return keyset_filter
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+
+        try:
+            cursor = json.loads(b64decode(encoded.encode("ascii"), altchars=b"-_"))
+            values = cursor["v"]
+            if not isinstance(values, list) or not isinstance(cursor["r"], bool):
+                raise ValueError
+            if len(values) != len(self.ordering) or None in values:
+                raise ValueError
+            # a tampered value of the wrong type would fail in the database instead
+            cursor["v"] = [
+                self._to_python(field, value) for field, value in zip(self.value_fields, values)
+            ]
+        except (TypeError, ValueError, KeyError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+        return cursor
+
+    def _to_python(self, field, value):
+        value = field.to_python(value)
+        field.run_validators(value)
+        return value
+
+    def encode_cursor(self, instance, reverse):
+        if isinstance(instance, dict):  # .values() row
+            values = [instance[field] for field, desc in self.ordering]
+        else:
+            values = [getattr(instance, field) for field, desc in self.ordering]
+        cursor = json.dumps({"v": values, "r": reverse}, cls=CursorEncoder)
+        encoded = b64encode(cursor.encode("utf-8"), altchars=b"-_").decode("ascii")
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def get_paginated_content(self, data):
+        return [
+            ("next", self.get_next_link()),
+            ("previous", self.get_previous_link()),
+            ("results", data),
+        ]
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict(self.get_paginated_content(data)))
+
+
+class ProductCursorPagination(KeysetPagination):
+    """
+    The total can be requested with ?count=estimate,
+    in which case the planner's estimate is returned.
+    """
+
+    page_size = 10
+    count_query_param = "count"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count = None
+        if request.query_params.get(self.count_query_param) == "estimate":
+            self.count = estimate_count(queryset)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_content(self, data):
+        content = super().get_paginated_content(data)
+        if self.count is not None:
+            content.insert(0, ("count", self.count))
+        return content
+
+
+class OrderCursorPagination(KeysetPagination):
+    page_size = 10
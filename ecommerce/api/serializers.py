@@ -1,9 +1,34 @@
-from datetime import timedelta
-
+import os
+from collections import OrderedDict, defaultdict
+from decimal import Decimal
+from functools import cached_property
+from operator import itemgetter
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.db.models import F, Value
+from django.db.models.functions import Least, Round
+from django.utils import timezone
+from django.utils.encoding import filepath_to_uri
+from PIL import Image
 from rest_framework import serializers
 
-from ecommerce import tasks
-from ecommerce.models import Order, OrderItem, Product, ProductCategory, ShippingAddress
+from ecommerce import outbox, tasks
+from ecommerce.cache import bump_catalogue_version
+from ecommerce.models import (
+    Order,
+    OrderItem,
+    Product,
+    ProductCategory,
+    ShippingAddress,
+    UploadSession,
+    UploadStatus,
+)
+
+from .filters import filter_products
 
 
 class ProductCategorySerializer(serializers.ModelSerializer):
@@ -19,25 +44,461 @@ class ReadonlyProductCategorySerializer(serializers.ModelSerializer):
 
 
 class ProductSerializer(serializers.ModelSerializer):
+    """
+    The image is either uploaded with the product
+    or given as the id of a completed upload session.
+    """
+
     price = serializers.FloatField()
+    upload = serializers.PrimaryKeyRelatedField(
+        queryset=UploadSession.objects.filter(status=UploadStatus.COMPLETE),
+        write_only=True,
+        required=False,
+        help_text="Id of a completed upload session, instead of the image.",
+    )
 
     class Meta:
         model = Product
-        exclude = ("image_min",)
+        exclude = "image_min", "image_min_status", "renditions", "search_vector"
+        extra_kwargs = {"image": {"required": False}}
+
+    def validate_upload(self, value):
+        if value.user_id != self.context["request"].user.pk:
+            raise serializers.ValidationError("Upload session not found.")
+        return value
+
+    def validate(self, attrs):
+        upload = attrs.pop("upload", None)
+        if upload is not None:
+            attrs["image"] = upload.image
+        elif self.instance is None and not attrs.get("image"):
+            raise serializers.ValidationError({"image": ["No image or upload given."]})
+        return attrs
+
+
+def build_srcset(renditions, get_url):
+    """
+    Returns the renditions as srcset attribute values per format:
+    {"webp": "<url> 320w, <url> 640w", ...}
+    """
+    return {
+        extension: ", ".join(f"{get_url(name)} {width}w" for width, name in sizes)
+        for extension, sizes in renditions.items()
+    }
+
+
+def _get_ordering_columns(queryset):
+    """
+    Returns the columns the queryset is ordered by, skipping annotations.
+    """
+    opts = queryset.model._meta
+    columns = []
+    for name in queryset.query.order_by:
+        name = name.lstrip("-")
+        if name == "pk":
+            columns.append(opts.pk.attname)
+        elif name not in queryset.query.annotations:
+            columns.append(opts.get_field(name).attname)
+    return columns
 
 
 class ReadonlyProductSerializer(serializers.ModelSerializer):
+    """
+    Sparse fieldsets: the "fields" context narrows the output to a subset of sparse_fields
+    and the category is embedded only if it is listed in the "expand" context,
+    otherwise it is represented by its id. Without those, all fields are returned
+    with the category embedded.
+    """
+
     category = ReadonlyProductCategorySerializer()
+    srcset = serializers.SerializerMethodField()
+
+    sparse_fields = {
+        "id": ("id",),
+        "category": ("category_id",),
+        "name": ("name",),
+        "description": ("description",),
+        "price": ("price",),
+        "image": ("image",),
+        "image_min": ("image_min",),
+        "image_min_status": ("image_min_status",),
+        "srcset": ("renditions",),
+        "updated_at": ("updated_at",),
+    }
+    expandable_fields = {"category": ("category__name",)}
 
     class Meta:
         model = Product
-        fields = "__all__"
+        exclude = "stock", "renditions", "search_vector"
+
+    @classmethod
+    def get_sparse_columns(cls, queryset, fields=None, expand=None):
+        """
+        Returns the columns needed to represent the given fields,
+        including the ones the queryset is ordered by (for pagination).
+        """
+        fields = cls.sparse_fields if fields is None else fields
+        expand = cls.expandable_fields if expand is None else expand
+
+        columns = ["id", *_get_ordering_columns(queryset)]
+        for name in fields:
+            columns += cls.sparse_fields[name]
+            if name in expand:
+                columns += cls.expandable_fields[name]
+
+        return list(dict.fromkeys(columns))
+
+    @classmethod
+    def setup_queryset(cls, queryset, fields=None, expand=None):
+        if fields is None or "category" in fields:
+            if expand is None or "category" in expand:
+                queryset = queryset.select_related("category")
+        if fields is not None:
+            queryset = queryset.only(*cls.get_sparse_columns(queryset, fields, expand))
+        return queryset
+
+    def get_fields(self):
+        fields = super().get_fields()
+
+        requested = self.context.get("fields")
+        if requested is not None:
+            fields = OrderedDict((name, fields[name]) for name in fields if name in requested)
+
+        expand = self.context.get("expand")
+        if "category" in fields and expand is not None and "category" not in expand:
+            fields["category"] = serializers.PrimaryKeyRelatedField(read_only=True)
+
+        return fields
+
+    def get_srcset(self, product):
+        request = self.context.get("request")
+
+        def get_url(name):
+            url = default_storage.url(name)
+            return request.build_absolute_uri(url) if request is not None else url
+
+        return build_srcset(product.renditions, get_url)
+
+
+class ReadonlyProductValuesSerializer(ReadonlyProductSerializer):
+    """
+    Fast read path with the same output as ReadonlyProductSerializer.
+    Represents .values() rows directly: no field serializers are run per product
+    and the media url prefix is computed once per response.
+    """
+
+    @classmethod
+    def setup_queryset(cls, queryset, fields=None, expand=None):
+        columns = cls.get_sparse_columns(queryset, fields, expand)
+        return queryset.values(*columns, *queryset.query.annotations)
+
+    @cached_property
+    def media_prefix(self):
+        base_url = Product.image.field.storage.base_url
+        request = self.context.get("request")
+        return request.build_absolute_uri(base_url) if request is not None else base_url
+
+    def get_media_url(self, name):
+        if not name:
+            return None
+        return self.media_prefix + filepath_to_uri(name).lstrip("/")
+
+    @cached_property
+    def representation(self):
+        """
+        (name, getter) pairs of the represented fields, resolved once per response.
+        """
+        fields = self.fields
+
+        def get_category(row):
+            return {"id": row["category_id"], "name": row["category__name"]}
+
+        getters = {
+            "id": itemgetter("id"),
+            "category": itemgetter("category_id"),
+            "name": itemgetter("name"),
+            "description": itemgetter("description"),
+            "price": lambda row: fields["price"].to_representation(row["price"]),
+            "image": lambda row: self.get_media_url(row["image"]),
+            "image_min": lambda row: self.get_media_url(row["image_min"]),
+            "image_min_status": itemgetter("image_min_status"),
+            "srcset": lambda row: build_srcset(row["renditions"], self.get_media_url),
+            "updated_at": lambda row: fields["updated_at"].to_representation(row["updated_at"]),
+        }
+        if isinstance(fields.get("category"), ReadonlyProductCategorySerializer):
+            getters["category"] = get_category
+
+        return [(name, getters[name]) for name in fields]
+
+    def to_representation(self, row):
+        return {name: getter(row) for name, getter in self.representation}
+
+
+class ProductFilterSerializer(serializers.Serializer):
+    q = serializers.CharField(required=False)
+    name = serializers.CharField(required=False)
+    category = serializers.CharField(required=False)
+    desc = serializers.CharField(required=False)
+    price = serializers.DecimalField(max_digits=6, decimal_places=2, required=False)
+    price_min = serializers.DecimalField(max_digits=6, decimal_places=2, required=False)
+    price_max = serializers.DecimalField(max_digits=6, decimal_places=2, required=False)
+
+    def validate(self, attrs):
+        price_min = attrs.get("price_min")
+        price_max = attrs.get("price_max")
+        if price_min is not None and price_max is not None and price_min > price_max:
+            raise serializers.ValidationError("price_min must not be greater than price_max")
+
+        return attrs
+
+
+class ProductImportSerializer(serializers.Serializer):
+    """
+    A single row of a product import.
+    Expects the known categories and archive members in the context.
+    """
+
+    name = serializers.CharField(max_length=100)
+    description = serializers.CharField(required=False, allow_blank=True, allow_null=True)
+    price = serializers.DecimalField(max_digits=6, decimal_places=2, min_value=0)
+    category = serializers.CharField()
+    image = serializers.CharField(max_length=100)
+
+    def validate_category(self, value):
+        category_id = self.context["categories"].get(value.strip().lower())
+        if category_id is None:
+            raise serializers.ValidationError("Unknown category.")
+        return category_id
+
+    def validate_image(self, value):
+        if value in self.context["archive_members"]:
+            return value
+
+        try:
+            exists = default_storage.exists(value)
+        except SuspiciousFileOperation:  # ex. ../x or an absolute path
+            raise serializers.ValidationError("Invalid image path.")
+        if not exists:
+            raise serializers.ValidationError("Image not found.")
+        return value
+
+
+class ProductImportRequestSerializer(serializers.Serializer):
+    file = serializers.FileField(help_text="CSV or JSON Lines file of products.")
+    archive = serializers.FileField(
+        required=False, help_text="Zip archive with the images referenced by the products."
+    )
+    format = serializers.ChoiceField(
+        choices=["csv", "jsonl"],
+        required=False,
+        help_text="Defaults to the file's extension (.jsonl, .ndjson or .csv).",
+    )
+
+
+class ProductImportResponseSerializer(serializers.Serializer):
+    created = serializers.IntegerField()
+    errors = serializers.ListField(child=serializers.DictField())
+    seconds = serializers.FloatField()
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    ALLOWED_EXTENSIONS = [".jpg", ".jpeg", ".png", ".webp", ".gif"]
+
+    class Meta:
+        model = UploadSession
+        fields = "id", "filename", "size", "offset", "status", "image"
+        read_only_fields = "offset", "status", "image"
+
+    def validate_filename(self, value):
+        if os.path.splitext(value)[1].lower() not in self.ALLOWED_EXTENSIONS:
+            raise serializers.ValidationError(
+                f"Allowed extensions: {', '.join(self.ALLOWED_EXTENSIONS)}."
+            )
+        return os.path.basename(value)
+
+    def validate_size(self, value):
+        if not 0 < value <= settings.PRODUCT_UPLOAD_MAX_SIZE:
+            raise serializers.ValidationError(
+                f"The size has to be between 1 and {settings.PRODUCT_UPLOAD_MAX_SIZE} bytes."
+            )
+        return value
+
+    def create(self, validated_data):
+        return UploadSession.objects.create(user=self.context["request"].user, **validated_data)
+
+
+class UploadSessionFinalizeSerializer(serializers.Serializer):
+    """
+    Completes an upload session: the image's header is checked (its pixels are not decoded)
+    and the file is moved from the part file to the media storage.
+    """
+
+    ALLOWED_FORMATS = ["JPEG", "PNG", "WEBP", "GIF"]
+
+    def validate(self, attrs):
+        session = self.instance
+        if session.status == UploadStatus.COMPLETE:
+            return attrs
+        if session.offset != session.size:
+            raise serializers.ValidationError(
+                f"The upload is incomplete: {session.offset} of {session.size} bytes received."
+            )
+
+        try:
+            with Image.open(session.part_path) as image:  # reads the header only
+                image_format, (width, height) = image.format, image.size
+        except (OSError, Image.DecompressionBombError):
+            raise serializers.ValidationError("The file is not an image.")
+
+        if image_format not in self.ALLOWED_FORMATS:
+            raise serializers.ValidationError(f"Unsupported image format: {image_format}.")
+        if width * height > settings.PRODUCT_IMAGE_MAX_PIXELS:
+            raise serializers.ValidationError(
+                f"The image exceeds {settings.PRODUCT_IMAGE_MAX_PIXELS} pixels."
+            )
+
+        return attrs
+
+    def update(self, instance, validated_data):
+        if instance.status == UploadStatus.COMPLETE:
+            return instance
+
+        with open(instance.part_path, "rb") as part:
+            instance.image = default_storage.save(
+                Product.IMAGE_FULL_DIR + instance.filename, File(part)
+            )
+
+        instance.status = UploadStatus.COMPLETE
+        instance.save(update_fields=["image", "status"])
+        instance.delete_part()
+        return instance
+
+    def to_representation(self, instance):
+        return UploadSessionSerializer(instance).data
+
+
+class ProductBulkChangeSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    price = serializers.DecimalField(max_digits=6, decimal_places=2, min_value=0, required=False)
+    category = serializers.IntegerField(required=False)
+
+    def validate(self, attrs):
+        if "price" not in attrs and "category" not in attrs:
+            raise serializers.ValidationError("price or category is required")
+        return attrs
+
+
+class ProductBulkUpdateResponseSerializer(serializers.Serializer):
+    updated = serializers.IntegerField()
+
+
+class ProductBulkUpdateSerializer(serializers.Serializer):
+    """
+    Either a list of per product changes or a filter (as in the product list)
+    with a price change in percents. Everything is applied in one transaction
+    with set based UPDATE statements.
+
+    The filter is required with percent, the whole catalogue is repriced only
+    with an explicit empty filter.
+    """
+
+    changes = ProductBulkChangeSerializer(many=True, required=False)
+    filter = ProductFilterSerializer(required=False)
+    percent = serializers.DecimalField(
+        max_digits=5, decimal_places=2, min_value=-100, required=False
+    )
+
+    CHANGES_BATCH_SIZE = 5000
+    MAX_PRICE = Decimal("9999.99")
+
+    def validate_changes(self, changes):
+        ids = [change["id"] for change in changes]
+        if len(ids) != len(set(ids)):
+            raise serializers.ValidationError("Products must not be repeated.")
+
+        existing = set(Product.objects.filter(pk__in=ids).values_list("pk", flat=True))
+        missing = [pk for pk in ids if pk not in existing]
+        if missing:
+            raise serializers.ValidationError(f"Products do not exist: {missing}.")
+
+        category_ids = {change["category"] for change in changes if "category" in change}
+        existing = set(
+            ProductCategory.objects.filter(pk__in=category_ids).values_list("pk", flat=True)
+        )
+        missing = sorted(category_ids - existing)
+        if missing:
+            raise serializers.ValidationError(f"Categories do not exist: {missing}.")
+
+        return changes
+
+    def validate(self, attrs):
+        if ("changes" in attrs) == ("percent" in attrs):
+            raise serializers.ValidationError("Either changes or percent is required.")
+        if ("filter" in attrs) != ("percent" in attrs):
+            raise serializers.ValidationError("filter and percent must be used together.")
+        return attrs
+
+    def _apply_changes(self, changes, now):
+        updated = 0
+        with connection.cursor() as cursor:
+            for i in range(0, len(changes), self.CHANGES_BATCH_SIZE):
+                batch = changes[i : i + self.CHANGES_BATCH_SIZE]
+                values = ", ".join(["(%s::bigint, %s::numeric, %s::bigint)"] * len(batch))
+                params = [
+                    param
+                    for change in batch
+                    for param in (change["id"], change.get("price"), change.get("category"))
+                ]
+                cursor.execute(
+                    f"""
+                    UPDATE ecommerce_product AS product SET
+                        price = COALESCE(changes.price, product.price),
+                        category_id = COALESCE(changes.category_id, product.category_id),
+                        updated_at = %s
+                    FROM (VALUES {values}) AS changes (id, price, category_id)
+                    WHERE product.id = changes.id
+                    """,
+                    [now, *params],
+                )
+                updated += cursor.rowcount
+        return updated
+
+    def _apply_percent(self, filters, percent, now):
+        factor = 1 + percent / 100
+        products = filter_products(Product.objects.all(), filters).order_by()
+        return products.update(
+            price=Least(Round(F("price") * factor, 2), Value(self.MAX_PRICE)),
+            updated_at=now,
+        )
+
+    def create(self, validated_data):
+        now = timezone.now()
+
+        with transaction.atomic():
+            if "changes" in validated_data:
+                updated = self._apply_changes(validated_data["changes"], now)
+            else:
+                updated = self._apply_percent(
+                    validated_data["filter"], validated_data["percent"], now
+                )
+            # bulk updates bypass the models' signals
+            transaction.on_commit(bump_catalogue_version)
+
+        return {"updated": updated}
+
+    def to_representation(self, instance):
+        response_serializer = ProductBulkUpdateResponseSerializer(instance)
+        return response_serializer.data
 
 
 class OrderItemSerializer(serializers.ModelSerializer):
+    # resolved to instances for all the items at once by OrderSerializer
+    product = serializers.IntegerField(min_value=1)
+
     class Meta:
         model = OrderItem
         exclude = "id", "order"
+        read_only_fields = ("unit_price",)
 
 
 class ShippingAddressSerializer(serializers.ModelSerializer):
@@ -50,11 +511,51 @@ class ShippingAddressSerializer(serializers.ModelSerializer):
 
 
 class OrderResponseSerializer(serializers.ModelSerializer):
+    total_price = serializers.FloatField()
+
     class Meta:
         model = Order
         fields = "total_price", "payment_deadline"
 
 
+class OrderHistoryProductSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Product
+        fields = "id", "name"
+
+
+class OrderHistoryItemSerializer(serializers.ModelSerializer):
+    product = OrderHistoryProductSerializer()
+    unit_price = serializers.FloatField()
+
+    class Meta:
+        model = OrderItem
+        fields = "product", "quantity", "unit_price"
+
+
+class OrderHistorySerializer(serializers.ModelSerializer):
+    """
+    Expects the shipping address and the items with their products to be loaded
+    (see views._get_order_history).
+    """
+
+    items = OrderHistoryItemSerializer(many=True)
+    shipping_address = ShippingAddressSerializer()
+    total_price = serializers.FloatField()
+
+    class Meta:
+        model = Order
+        fields = (
+            "id",
+            "created_at",
+            "payment_deadline",
+            "payment_status",
+            "total_price",
+            "shipping_address",
+            "items",
+        )
+
+
 class OrderSerializer(serializers.ModelSerializer):
     items = OrderItemSerializer(many=True)
     shipping_address = ShippingAddressSerializer()
@@ -63,43 +564,48 @@ class OrderSerializer(serializers.ModelSerializer):
         model = Order
         exclude = "id", "created_at", "payment_deadline", "user"
 
-    def _send_order_confirmation(self, order):
-        tasks.queue_email.delay(
-            temp_subject="ecommerce/email/order_confirm_subject.txt",
-            temp_html="ecommerce/email/order_confirm.html",
-            temp_str="ecommerce/email/order_confirm.txt",
-            context={
-                "order": str(order),
-                "items": [
-                    {
-                        "name": item.product.name,
-                        "price": item.product.price,
-                        "quantity": item.quantity,
-                    }
-                    for item in order.items.all()
-                ],
-                "total": order.total_price,
-                "payment_deadline": order.payment_deadline,
-            },
-            recipients=[order.user.email],
-        )
+    def validate_items(self, items):
+        product_ids = {item_data["product"] for item_data in items}
+        products = Product.objects.in_bulk(product_ids)
+
+        missing = sorted(product_ids - products.keys())
+        if missing:
+            raise serializers.ValidationError(
+                f"Invalid product ids: {', '.join(map(str, missing))}."
+            )
+
+        return [item_data | {"product": products[item_data["product"]]} for item_data in items]
 
-    def _queue_payment_reminder(self, order):
-        tasks.queue_email.apply_async(
-            kwargs={
-                "temp_subject": "ecommerce/email/payment_reminder_subject.txt",
-                "temp_html": "ecommerce/email/payment_reminder.html",
-                "temp_str": "ecommerce/email/payment_reminder.txt",
-                "context": {
-                    "order": str(order),
-                    "total": order.total_price,
-                    "payment_deadline": order.payment_deadline,
-                },
-                "recipients": [order.user.email],
-            },
-            eta=order.payment_deadline + timedelta(days=1),
+    def _send_order_confirmation(self, order):
+        # the worker renders the email from the order
+        outbox.enqueue(
+            tasks.send_order_email,
+            kwargs={"order_id": order.pk, "template": "order_confirmation"},
+            dedupe_key=f"order-confirmation:{order.pk}",
         )
 
+    def _reserve_stock(self, items):
+        """
+        Decrements the stock of the ordered products with conditional updates, which lock
+        only the updated rows and fail instead of overselling. The products are updated
+        in the order of their ids, so concurrent orders can not deadlock.
+        """
+        quantities = defaultdict(int)
+        for item in items:
+            if item.product.stock is not None:
+                quantities[item.product.pk] += item.quantity
+
+        for product_id in sorted(quantities):
+            quantity = quantities[product_id]
+            reserved = Product.objects.filter(pk=product_id, stock__gte=quantity).update(
+                stock=F("stock") - quantity
+            )
+            if not reserved:
+                raise serializers.ValidationError(
+                    {"items": [f"Not enough stock of product {product_id}."]}
+                )
+
+    @transaction.atomic
     def create(self, validated_data):
         user = self.context["request"].user
         items = validated_data.pop("items")
@@ -108,15 +614,25 @@ class OrderSerializer(serializers.ModelSerializer):
         address, address_created = ShippingAddress.objects.get_or_create(
             **(shipping_address | {"user": user})
         )
+
+        # the products were loaded by validate_items
+        items = [
+            OrderItem(**item_data, unit_price=item_data["product"].price) for item_data in items
+        ]
+        self._reserve_stock(items)
+
         order = Order.objects.create(
-            **(validated_data | {"shipping_address": address, "user": user})
+            **(validated_data | {"shipping_address": address, "user": user}),
+            total_price=Order.calculate_total_price(items),
         )
 
-        items = [OrderItem(**(item_data | {"order": order})) for item_data in items]
+        for item in items:
+            item.order = order
         OrderItem.objects.bulk_create(items)
 
+        # published by the outbox relay once the order is committed,
+        # payment reminders are sent by tasks.send_payment_reminders
         self._send_order_confirmation(order)
-        self._queue_payment_reminder(order)
 
         return order
 
@@ -1,10 +1,33 @@
 from django.urls import path
 
-from .views import OrderListView, PopularProductsListView, ProductDetailView, ProductListView
+from .views import (
+    OrderDetailView,
+    OrderListView,
+    PopularProductsListView,
+    ProductBulkUpdateView,
+    ProductDetailView,
+    ProductExportView,
+    ProductImportView,
+    ProductListView,
+    UploadSessionDetailView,
+    UploadSessionFinalizeView,
+    UploadSessionListView,
+)
 
 urlpatterns = [
     path("products/", ProductListView.as_view(), name="products"),
+    path("products/export/", ProductExportView.as_view(), name="products-export"),
+    path("products/import/", ProductImportView.as_view(), name="products-import"),
+    path("products/bulk/", ProductBulkUpdateView.as_view(), name="products-bulk"),
+    path("products/uploads/", UploadSessionListView.as_view(), name="uploads"),
+    path("products/uploads/<uuid:pk>/", UploadSessionDetailView.as_view(), name="upload"),
+    path(
+        "products/uploads/<uuid:pk>/finalize/",
+        UploadSessionFinalizeView.as_view(),
+        name="upload-finalize",
+    ),
     path("product/<pk>/", ProductDetailView.as_view(), name="product"),
     path("orders/", OrderListView.as_view(), name="orders"),
+    path("order/<pk>/", OrderDetailView.as_view(), name="order"),
     path("popular/", PopularProductsListView.as_view(), name="popular"),
 ]
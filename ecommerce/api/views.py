@@ -1,21 +1,47 @@
-from django.db.models import Count
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Prefetch
 from django.db.utils import ProgrammingError
+from django.http import StreamingHttpResponse
 from drf_yasg import openapi
-from drf_yasg.utils import swagger_auto_schema
+from drf_yasg.utils import no_body, swagger_auto_schema
 from rest_framework import generics, parsers, permissions, status
+from rest_framework.exceptions import ValidationError
+from rest_framework.generics import get_object_or_404
+from rest_framework.response import Response
 from rest_framework_simplejwt.authentication import JWTAuthentication
 
 from core.api.permissions import IsCustomer, IsSeller
-from ecommerce.models import Order, Product, ProductCategory
+from ecommerce import exporters
+from ecommerce.cache import get_or_build, make_catalogue_key
+from ecommerce.importers import ProductImport, get_format
+from ecommerce.models import (
+    Order,
+    OrderItem,
+    Product,
+    ProductCategory,
+    UploadSession,
+    UploadStatus,
+)
 
-from .pagination import ProductPagination
+from .filters import filter_products, get_product_facets
+from .mixins import CatalogueCacheMixin, IdempotentCreateMixin, SparseFieldsMixin
+from .pagination import OrderCursorPagination, ProductCursorPagination, ProductPagination
 from .serializers import (
+    OrderHistorySerializer,
     OrderResponseSerializer,
     OrderSerializer,
     PopularProductResponseSerializer,
     PopularProductsRequestSerializer,
+    ProductBulkUpdateResponseSerializer,
+    ProductBulkUpdateSerializer,
+    ProductFilterSerializer,
+    ProductImportRequestSerializer,
+    ProductImportResponseSerializer,
     ProductSerializer,
-    ReadonlyProductSerializer,
+    ReadonlyProductValuesSerializer,
+    UploadSessionFinalizeSerializer,
+    UploadSessionSerializer,
 )
 
 
@@ -43,9 +69,30 @@ def _get_categories_enum():
     return enum_str, enum_int
 
 
-class ProductListView(generics.ListCreateAPIView):
+SPARSE_FIELDSET_PARAMETERS = [
+    openapi.Parameter(
+        "fields",
+        openapi.IN_QUERY,
+        type=openapi.TYPE_STRING,
+        description="Comma separated fields to return, ex. id,name,price,image_min",
+    ),
+    openapi.Parameter(
+        "expand",
+        openapi.IN_QUERY,
+        type=openapi.TYPE_STRING,
+        enum=["category"],
+        description="Embeds the category when fields are given (otherwise its id is returned).",
+    ),
+]
+
+
+class ProductListView(SparseFieldsMixin, CatalogueCacheMixin, generics.ListCreateAPIView):
+    cache_prefix = "products"
     pagination_class = ProductPagination
-    parser_classes = [parsers.MultiPartParser]
+    cursor_pagination_class = ProductCursorPagination
+    # JSON for products attached to an upload session
+    parser_classes = [parsers.MultiPartParser, parsers.JSONParser]
+    read_serializer_class = ReadonlyProductValuesSerializer
 
     @swagger_auto_schema(
         operation_description="Returns the list of products.",
@@ -56,6 +103,12 @@ class ProductListView(generics.ListCreateAPIView):
                 type=openapi.TYPE_STRING,
                 enum=["name", "category", "price"],
             ),
+            openapi.Parameter(
+                "q",
+                openapi.IN_QUERY,
+                type=openapi.TYPE_STRING,
+                description="Searches names and descriptions, ordered by relevance.",
+            ),
             openapi.Parameter("name", openapi.IN_QUERY, type=openapi.TYPE_STRING),
             openapi.Parameter(
                 "category",
@@ -65,6 +118,30 @@ class ProductListView(generics.ListCreateAPIView):
             ),
             openapi.Parameter("desc", openapi.IN_QUERY, type=openapi.TYPE_STRING),
             openapi.Parameter("price", openapi.IN_QUERY, type=openapi.TYPE_NUMBER),
+            openapi.Parameter("price_min", openapi.IN_QUERY, type=openapi.TYPE_NUMBER),
+            openapi.Parameter("price_max", openapi.IN_QUERY, type=openapi.TYPE_NUMBER),
+            openapi.Parameter(
+                "facets",
+                openapi.IN_QUERY,
+                type=openapi.TYPE_BOOLEAN,
+                description="Adds category counts and a price histogram of the filtered products.",
+            ),
+            openapi.Parameter(
+                "pagination",
+                openapi.IN_QUERY,
+                type=openapi.TYPE_STRING,
+                enum=["page", "cursor"],
+                description="Cursor pagination skips counting and offsetting the products.",
+            ),
+            openapi.Parameter("cursor", openapi.IN_QUERY, type=openapi.TYPE_STRING),
+            *SPARSE_FIELDSET_PARAMETERS,
+            openapi.Parameter(
+                "count",
+                openapi.IN_QUERY,
+                type=openapi.TYPE_STRING,
+                enum=["estimate"],
+                description="Adds an estimated total to cursor paginated responses.",
+            ),
         ],
     )
     def get(self, request, *args, **kwargs):
@@ -90,10 +167,19 @@ class ProductListView(generics.ListCreateAPIView):
     def post(self, request, *args, **kwargs):
         return super().post(request, *args, **kwargs)
 
+    @property
+    def paginator(self):
+        if not hasattr(self, "_paginator"):
+            if self.request is not None and self.request.GET.get("pagination") == "cursor":
+                self._paginator = self.cursor_pagination_class()
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
+
     def get_serializer_class(self):
         if self.request.method == "POST":
             return ProductSerializer
-        return ReadonlyProductSerializer
+        return self.read_serializer_class
 
     def get_authenticators(self):
         if self.request.method == "POST":
@@ -105,42 +191,62 @@ class ProductListView(generics.ListCreateAPIView):
             return [permission() for permission in [permissions.IsAuthenticated, IsSeller]]
         return []
 
+    def get_filter_data(self):
+        if not hasattr(self, "_filter_data"):
+            # empty parameters are treated as not given
+            params = {key: value for key, value in self.request.GET.items() if value}
+            serializer = ProductFilterSerializer(data=params)
+            serializer.is_valid(raise_exception=True)
+            self._filter_data = serializer.validated_data
+        return self._filter_data
+
+    def get_filtered_queryset(self):
+        return filter_products(Product.objects.all(), self.get_filter_data())
+
+    def get_validator_queryset(self):
+        return self.get_filtered_queryset()
+
+    def get_facets(self):
+        filter_data = self.get_filter_data()
+        key = make_catalogue_key(
+            "facets",
+            sorted((name, filter_data.get(name)) for name in filter_data),
+            version=self.get_catalogue_state()[0],
+        )
+        return get_or_build(key, lambda: get_product_facets(self.get_filtered_queryset()))
+
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+        if self.request.GET.get("facets") in ["1", "true"]:
+            response.data["facets"] = self.get_facets()
+        return response
+
     def get_queryset(self):
         if self.request.method == "POST":
             return Product.objects.all()
 
-        products = Product.objects.all().order_by("pk")
-
-        # apply filters
-        name = self.request.GET.get("name")
-        category = self.request.GET.get("category")
-        description = self.request.GET.get("desc")
-        price = self.request.GET.get("price")
-
-        if name:
-            products = products.filter(name__icontains=name)
-        if category:
-            products = products.filter(category__name__iexact=category)
-        if description:
-            products = products.filter(description__icontains=description)
-        if price:
-            products = products.filter(price=price)
+        products = self.get_filtered_queryset()
 
         # apply ordering
         order_by = self.request.GET.get("order")
 
         if order_by:
-            products = products.order_by(order_by)
+            products = products.order_by(order_by, "pk")
 
-        return products
+        return self.read_serializer_class.setup_queryset(products, **self.get_sparse_fieldset())
 
 
-class ProductDetailView(generics.RetrieveUpdateDestroyAPIView):
-    queryset = Product.objects.all()
-    parser_classes = [parsers.MultiPartParser]
+class ProductDetailView(
+    SparseFieldsMixin, CatalogueCacheMixin, generics.RetrieveUpdateDestroyAPIView
+):
+    cache_prefix = "product"
+    # JSON for products attached to an upload session
+    parser_classes = [parsers.MultiPartParser, parsers.JSONParser]
+    read_serializer_class = ReadonlyProductValuesSerializer
 
     @swagger_auto_schema(
         operation_description="Returns the product with the given id.",
+        manual_parameters=SPARSE_FIELDSET_PARAMETERS,
     )
     def get(self, request, *args, **kwargs):
         return super().get(request, *args, **kwargs)
@@ -202,7 +308,14 @@ class ProductDetailView(generics.RetrieveUpdateDestroyAPIView):
     def get_serializer_class(self):
         if self.request.method in ["PUT", "PATCH", "DELETE"]:
             return ProductSerializer
-        return ReadonlyProductSerializer
+        return self.read_serializer_class
+
+    def get_queryset(self):
+        if self.request.method in ["PUT", "PATCH", "DELETE"]:
+            return Product.objects.all()
+        return self.read_serializer_class.setup_queryset(
+            Product.objects.all(), **self.get_sparse_fieldset()
+        )
 
     def get_authenticators(self):
         if self.request.method in ["PUT", "PATCH", "DELETE"]:
@@ -215,15 +328,339 @@ class ProductDetailView(generics.RetrieveUpdateDestroyAPIView):
         return []
 
 
-class OrderListView(generics.CreateAPIView):
-    queryset = Order.objects.all()
-    serializer_class = OrderSerializer
+class ProductExportView(generics.GenericAPIView):
+    authentication_classes = []
+    permission_classes = []
+    get_description = """
+        Streams all the products matching the filters (same as in the products list)
+        as NDJSON or CSV, without pagination.
+    """
+
+    @swagger_auto_schema(
+        operation_description=get_description,
+        manual_parameters=[
+            openapi.Parameter(
+                "output",
+                openapi.IN_QUERY,
+                type=openapi.TYPE_STRING,
+                enum=list(exporters.FORMATS),
+                default="ndjson",
+            ),
+            openapi.Parameter(
+                "gzip",
+                openapi.IN_QUERY,
+                type=openapi.TYPE_BOOLEAN,
+                description="Compresses the response (Content-Encoding: gzip).",
+            ),
+            openapi.Parameter("q", openapi.IN_QUERY, type=openapi.TYPE_STRING),
+            openapi.Parameter("name", openapi.IN_QUERY, type=openapi.TYPE_STRING),
+            openapi.Parameter(
+                "category",
+                openapi.IN_QUERY,
+                type=openapi.TYPE_STRING,
+                enum=_get_categories_enum()[0],  # str enum
+            ),
+            openapi.Parameter("desc", openapi.IN_QUERY, type=openapi.TYPE_STRING),
+            openapi.Parameter("price", openapi.IN_QUERY, type=openapi.TYPE_NUMBER),
+            openapi.Parameter("price_min", openapi.IN_QUERY, type=openapi.TYPE_NUMBER),
+            openapi.Parameter("price_max", openapi.IN_QUERY, type=openapi.TYPE_NUMBER),
+        ],
+    )
+    def get(self, request, *args, **kwargs):
+        params = {key: value for key, value in request.GET.items() if value}
+        serializer = ProductFilterSerializer(data=params)
+        serializer.is_valid(raise_exception=True)
+
+        format = request.GET.get("output", "ndjson")
+        if format not in exporters.FORMATS:
+            raise ValidationError({"output": [f"Must be one of: {', '.join(exporters.FORMATS)}."]})
+        compress = request.GET.get("gzip") in ["1", "true"]
+
+        products = filter_products(Product.objects.all(), serializer.validated_data)
+        products = ReadonlyProductValuesSerializer.setup_queryset(products)
+
+        # a server-side cursor on PostgreSQL, fetched in chunks
+        chunk_size = settings.PRODUCT_EXPORT_CHUNK_SIZE
+        rows = products.iterator(chunk_size=chunk_size)
+
+        representation = ReadonlyProductValuesSerializer(context={"request": request})
+        response = StreamingHttpResponse(
+            exporters.export_products(
+                map(representation.to_representation, rows), format, chunk_size, compress
+            ),
+            content_type=exporters.CONTENT_TYPES[format],
+        )
+        response["Content-Disposition"] = f'attachment; filename="products.{format}"'
+        if compress:
+            response["Content-Encoding"] = "gzip"
+        return response
+
+
+class ProductImportView(generics.GenericAPIView):
+    serializer_class = ProductImportRequestSerializer
+    parser_classes = [parsers.MultiPartParser]
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [permissions.IsAuthenticated, IsSeller]
+
+    post_description = """
+        Imports products from a CSV or JSON Lines file.
+        Columns: name, description, price, category (name or id), image.
+        Images are paths in the media storage or members of the uploaded zip archive.
+
+        Invalid rows are reported and skipped, the rest is imported.
+        Miniatures are created in the background.
+    """
+
+    @swagger_auto_schema(
+        operation_description=post_description,
+        manual_parameters=[
+            openapi.Parameter(
+                "Authorization",
+                openapi.IN_HEADER,
+                type=openapi.TYPE_STRING,
+                default="Bearer <access>",
+            ),
+        ],
+        responses={status.HTTP_200_OK: ProductImportResponseSerializer},
+    )
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        file = serializer.validated_data["file"]
+        format = serializer.validated_data.get("format") or get_format(file.name)
+
+        product_import = ProductImport(archive=serializer.validated_data.get("archive"))
+        report = product_import.run(file, format)
+
+        return Response(ProductImportResponseSerializer(report).data, status=status.HTTP_200_OK)
+
+
+class UploadSessionListView(generics.CreateAPIView):
+    serializer_class = UploadSessionSerializer
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [permissions.IsAuthenticated, IsSeller]
+
+    post_description = """
+        Starts a resumable upload of a product image of the given size (in bytes).
+        The file is sent in chunks with PUT /products/uploads/<id>/, completed with
+        POST /products/uploads/<id>/finalize/ and attached to products by the session's id
+        ("upload" field of a product).
+    """
+
+    @swagger_auto_schema(
+        operation_description=post_description,
+        manual_parameters=[
+            openapi.Parameter(
+                "Authorization",
+                openapi.IN_HEADER,
+                type=openapi.TYPE_STRING,
+                default="Bearer <access>",
+            ),
+        ],
+    )
+    def post(self, request, *args, **kwargs):
+        return super().post(request, *args, **kwargs)
+
+
+class UploadSessionDetailView(generics.RetrieveAPIView):
+    serializer_class = UploadSessionSerializer
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [permissions.IsAuthenticated, IsSeller]
+    parser_classes = []  # chunks are streamed from the request body
+
+    get_description = """
+        Returns the upload session. Its offset is the number of bytes received so far,
+        an interrupted upload is resumed by sending the file from there.
+    """
+    put_description = """
+        Writes the request body (raw bytes, at most PRODUCT_UPLOAD_MAX_CHUNK_SIZE)
+        to the file at the position given by the Upload-Offset header.
+        The offset can not be past the bytes received so far (409 Conflict), a retried chunk
+        overwrites everything received after its offset.
+    """
+
+    def get_queryset(self):
+        return UploadSession.objects.filter(user=self.request.user)
+
+    @swagger_auto_schema(
+        operation_description=get_description,
+        manual_parameters=[
+            openapi.Parameter(
+                "Authorization",
+                openapi.IN_HEADER,
+                type=openapi.TYPE_STRING,
+                default="Bearer <access>",
+            ),
+        ],
+    )
+    def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
+
+    @swagger_auto_schema(
+        operation_description=put_description,
+        manual_parameters=[
+            openapi.Parameter(
+                "Authorization",
+                openapi.IN_HEADER,
+                type=openapi.TYPE_STRING,
+                default="Bearer <access>",
+            ),
+            openapi.Parameter(
+                "Upload-Offset", openapi.IN_HEADER, type=openapi.TYPE_INTEGER, required=True
+            ),
+        ],
+        responses={status.HTTP_200_OK: UploadSessionSerializer},
+    )
+    def put(self, request, *args, **kwargs):
+        try:
+            offset = int(request.headers["Upload-Offset"])
+            length = int(request.META.get("CONTENT_LENGTH") or 0)
+        except (KeyError, ValueError):
+            raise ValidationError({"Upload-Offset": ["A number of bytes is required."]})
+
+        if length < 0 or length > settings.PRODUCT_UPLOAD_MAX_CHUNK_SIZE:
+            raise ValidationError(
+                {
+                    "chunk": [
+                        f"Chunks are limited to {settings.PRODUCT_UPLOAD_MAX_CHUNK_SIZE} bytes."
+                    ]
+                }
+            )
+
+        session = get_object_or_404(self.get_queryset(), **kwargs)
+        if conflict := self._check_offset(session, offset, length):
+            return conflict
+
+        # the body is received before the session is locked, which is then held
+        # only to write the chunk from the local disk to the part file
+        with session.receive_chunk(request.stream, length) as chunk:
+            with transaction.atomic():
+                session = get_object_or_404(self.get_queryset().select_for_update(), **kwargs)
+                if conflict := self._check_offset(session, offset, length):
+                    return conflict
+
+                if length:
+                    session.write_chunk(chunk, offset, length)
+                    session.save(update_fields=["offset"])
+
+        return Response(
+            self.get_serializer(session).data, headers={"Upload-Offset": session.offset}
+        )
+
+    def _check_offset(self, session, offset, length):
+        """
+        Returns the 409 response of a chunk that can not be written at the offset,
+        raises a ValidationError for a chunk past the declared size.
+        """
+        if session.status == UploadStatus.COMPLETE or offset > session.offset:
+            return Response(
+                self.get_serializer(session).data,
+                status=status.HTTP_409_CONFLICT,
+                headers={"Upload-Offset": session.offset},
+            )
+        if offset < 0 or offset + length > session.size:
+            raise ValidationError({"chunk": ["The chunk exceeds the declared size."]})
+        return None
+
+
+class UploadSessionFinalizeView(generics.GenericAPIView):
+    serializer_class = UploadSessionFinalizeSerializer
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [permissions.IsAuthenticated, IsSeller]
+
+    post_description = """
+        Completes the upload once all the bytes are received. The image's format and dimensions
+        are validated and the file is moved to the media storage.
+    """
+
+    def get_queryset(self):
+        return UploadSession.objects.filter(user=self.request.user)
+
+    @swagger_auto_schema(
+        operation_description=post_description,
+        manual_parameters=[
+            openapi.Parameter(
+                "Authorization",
+                openapi.IN_HEADER,
+                type=openapi.TYPE_STRING,
+                default="Bearer <access>",
+            ),
+        ],
+        request_body=no_body,
+        responses={status.HTTP_200_OK: UploadSessionSerializer},
+    )
+    def post(self, request, *args, **kwargs):
+        with transaction.atomic():
+            session = get_object_or_404(self.get_queryset().select_for_update(), **kwargs)
+            serializer = self.get_serializer(session, data={})
+            serializer.is_valid(raise_exception=True)
+            serializer.save()
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
+
+class ProductBulkUpdateView(generics.GenericAPIView):
+    serializer_class = ProductBulkUpdateSerializer
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [permissions.IsAuthenticated, IsSeller]
+
+    patch_description = """
+        Updates prices and categories of many products at once.
+        Either with a list of changes: {"changes": [{"id": 1, "price": 9.99}, {"id": 2, "category": 3}]}
+        or with a price change in percents of the products matching a filter (same as in the products list):
+        {"filter": {"category": "Consoles"}, "percent": -10}
+        The filter is required, {"filter": {}, "percent": 5} reprices all the products.
+    """
+
+    @swagger_auto_schema(
+        operation_description=patch_description,
+        manual_parameters=[
+            openapi.Parameter(
+                "Authorization",
+                openapi.IN_HEADER,
+                type=openapi.TYPE_STRING,
+                default="Bearer <access>",
+            ),
+        ],
+        responses={status.HTTP_200_OK: ProductBulkUpdateResponseSerializer},
+    )
+    def patch(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
+
+def _get_order_history(user):
+    """
+    Returns the user's orders from the newest with everything OrderHistorySerializer reads,
+    loaded in two queries: the orders with their addresses and the items with their products.
+    """
+    items = OrderItem.objects.select_related("product").only(
+        "order_id", "quantity", "unit_price", "product__id", "product__name"
+    )
+    return (
+        Order.objects.filter(user=user)
+        .select_related("shipping_address")
+        .prefetch_related(Prefetch("items", queryset=items))
+        .order_by("-created_at", "-pk")
+    )
+
+
+class OrderListView(IdempotentCreateMixin, generics.ListCreateAPIView):
+    pagination_class = OrderCursorPagination
     authentication_classes = [JWTAuthentication]
     permission_classes = [permissions.IsAuthenticated, IsCustomer]
 
+    get_description = """
+        Returns the orders of the authenticated customer from the newest (cursor pagination).
+    """
     post_description = """
         Creates an order. 
         Responses with the total price and the payment deadline.
+
+        Retries sent with the same Idempotency-Key get the first response replayed
+        (with an Idempotent-Replayed header) instead of creating another order.
     """
 
     @swagger_auto_schema(
@@ -235,12 +672,63 @@ class OrderListView(generics.CreateAPIView):
                 type=openapi.TYPE_STRING,
                 default="Bearer <access>",
             ),
+            openapi.Parameter(
+                "Idempotency-Key",
+                openapi.IN_HEADER,
+                type=openapi.TYPE_STRING,
+                description="Unique key of the order, the same for its retries (kept for 24h).",
+            ),
         ],
         responses={status.HTTP_201_CREATED: OrderResponseSerializer},
     )
     def post(self, request, *args, **kwargs):
         return super().post(request, *args, **kwargs)
 
+    @swagger_auto_schema(
+        operation_description=get_description,
+        manual_parameters=[
+            openapi.Parameter(
+                "Authorization",
+                openapi.IN_HEADER,
+                type=openapi.TYPE_STRING,
+                default="Bearer <access>",
+            ),
+        ],
+    )
+    def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
+
+    def get_serializer_class(self):
+        if self.request.method == "POST":
+            return OrderSerializer
+        return OrderHistorySerializer
+
+    def get_queryset(self):
+        return _get_order_history(self.request.user)
+
+
+class OrderDetailView(generics.RetrieveAPIView):
+    serializer_class = OrderHistorySerializer
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [permissions.IsAuthenticated, IsCustomer]
+
+    @swagger_auto_schema(
+        operation_description="Returns the authenticated customer's order with the given id.",
+        manual_parameters=[
+            openapi.Parameter(
+                "Authorization",
+                openapi.IN_HEADER,
+                type=openapi.TYPE_STRING,
+                default="Bearer <access>",
+            ),
+        ],
+    )
+    def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
+
+    def get_queryset(self):
+        return _get_order_history(self.request.user)
+
 
 class PopularProductsListView(generics.ListAPIView):
     serializer_class = PopularProductsRequestSerializer
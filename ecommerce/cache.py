@@ -0,0 +1,88 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+CATALOGUE_VERSION_KEY = "catalogue:version"
+CATALOGUE_MODIFIED_KEY = "catalogue:modified"
+
+
+def _initial_version():
+    # a timestamp instead of 1, so that a version evicted from the cache
+    # is never re-issued for entries that may still be stored under it
+    return time.time_ns() // 1000
+
+
+def get_catalogue_state():
+    """
+    Returns the catalogue (version, modified) in a single cache round trip.
+    Modified is when the version was last bumped, None if not known.
+    """
+    state = cache.get_many([CATALOGUE_VERSION_KEY, CATALOGUE_MODIFIED_KEY])
+    version = state.get(CATALOGUE_VERSION_KEY)
+    if version is None:
+        cache.add(CATALOGUE_VERSION_KEY, _initial_version(), timeout=None)
+        version = cache.get(CATALOGUE_VERSION_KEY)
+    return version, state.get(CATALOGUE_MODIFIED_KEY)
+
+
+def get_catalogue_version():
+    return get_catalogue_state()[0]
+
+
+def bump_catalogue_version():
+    """
+    Invalidates every cached catalogue read at once by moving to a new version.
+    """
+    cache.set(CATALOGUE_MODIFIED_KEY, timezone.now(), timeout=None)
+    try:
+        cache.incr(CATALOGUE_VERSION_KEY)
+    except ValueError:
+        cache.add(CATALOGUE_VERSION_KEY, _initial_version(), timeout=None)
+
+
+def make_catalogue_key(prefix, *parts, version=None):
+    """
+    Pass the version already read for the request to save a round trip to the cache.
+    """
+    if version is None:
+        version = get_catalogue_version()
+    digest = hashlib.md5("|".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+    return f"catalogue:{prefix}:{version}:{digest}"
+
+
+def get_or_build(key, build, timeout=None):
+    """
+    Returns the cached value or builds and caches it.
+
+    Concurrent misses on the same key are collapsed: the first one takes a lock
+    and builds the value, the others wait for it to appear in the cache.
+    """
+    value = cache.get(key)
+    if value is not None:
+        return value
+
+    timeout = settings.CATALOGUE_CACHE_TIMEOUT if timeout is None else timeout
+    lock_key = f"{key}:lock"
+    lock_timeout = settings.CATALOGUE_CACHE_LOCK_TIMEOUT
+
+    if cache.add(lock_key, 1, timeout=lock_timeout):
+        try:
+            value = build()
+            cache.set(key, value, timeout)
+        finally:
+            cache.delete(lock_key)
+        return value
+
+    deadline = time.monotonic() + lock_timeout
+    while time.monotonic() < deadline:
+        time.sleep(0.05)
+        value = cache.get(key)
+        if value is not None:
+            return value
+        if cache.get(lock_key) is None:
+            break  # the building request failed
+
+    return build()
@@ -0,0 +1,64 @@
+import smtplib
+
+from django.conf import settings
+from django.core import mail
+from django.core.mail import EmailMultiAlternatives
+
+_connection = None
+
+
+def get_connection():
+    """
+    Returns the process' mail connection. It is opened (SMTP handshake, TLS and auth)
+    once and reused by all the emails the process sends.
+    """
+    global _connection
+    if _connection is None:
+        _connection = mail.get_connection()
+        _connection.open()
+    return _connection
+
+
+def close_connection():
+    global _connection
+    if _connection is not None:
+        try:
+            _connection.close()
+        finally:
+            _connection = None
+
+
+def build_messages(subject, text, html, recipients):
+    """
+    Returns a message per recipient, so that a refused address fails only its own.
+    """
+    messages = []
+    for recipient in recipients:
+        message = EmailMultiAlternatives(
+            subject=subject, body=text, from_email=settings.EMAIL_SENDER, to=[recipient]
+        )
+        message.attach_alternative(html, "text/html")
+        messages.append(message)
+    return messages
+
+
+def _send(message):
+    try:
+        get_connection().send_messages([message])
+    except smtplib.SMTPServerDisconnected:
+        # the server closed the idle connection
+        close_connection()
+        get_connection().send_messages([message])
+
+
+def send_messages(messages):
+    """
+    Sends the messages over the pooled connection and returns the ones that failed.
+    """
+    failed = []
+    for message in messages:
+        try:
+            _send(message)
+        except (smtplib.SMTPException, OSError):
+            failed.append(message)
+    return failed
@@ -0,0 +1,119 @@
+from functools import lru_cache
+
+from django.db.models import Prefetch
+from django.template import Context, engines
+from django.utils import translation
+
+from ecommerce.models import Order, OrderItem, PaymentStatus
+
+# template key: (subject, html, text)
+TEMPLATES = {
+    "order_confirmation": (
+        "ecommerce/email/order_confirm_subject.txt",
+        "ecommerce/email/order_confirm.html",
+        "ecommerce/email/order_confirm.txt",
+    ),
+    "payment_reminder": (
+        "ecommerce/email/payment_reminder_subject.txt",
+        "ecommerce/email/payment_reminder.html",
+        "ecommerce/email/payment_reminder.txt",
+    ),
+}
+
+
+@lru_cache(maxsize=None)
+def get_template(name):
+    """
+    Returns the compiled template, loaded and parsed once per process
+    (without the cached loader, as with DEBUG, render_to_string parses it on every call).
+    Changes to the templates need a restart of the worker.
+    """
+    return engines["django"].get_template(name).template
+
+
+@lru_cache(maxsize=None)
+def _render_subject(name, language):
+    return get_template(name).render(Context()).replace("\n", "")
+
+
+def render_subject(name):
+    """
+    Returns the subject template rendered without context, once per language.
+    """
+    return _render_subject(name, translation.get_language())
+
+
+def render_many(name, contexts):
+    """
+    Renders the template with each of the contexts, as render_to_string would
+    (with autoescaping, without context processors), pushing them on a single Context.
+    """
+    template = get_template(name)
+    context = Context(autoescape=template.engine.autoescape)
+
+    rendered = []
+    for values in contexts:
+        with context.push(values):
+            rendered.append(template.render(context))
+    return rendered
+
+
+def get_orders(order_ids):
+    """
+    Returns the orders with everything their emails read:
+    the users in the same query and the items with their products in a second one.
+    """
+    items = OrderItem.objects.select_related("product")
+    return (
+        Order.objects.filter(pk__in=order_ids)
+        .select_related("user")
+        .prefetch_related(Prefetch("items", queryset=items))
+    )
+
+
+def get_order_confirmation_context(order):
+    return {
+        "order": str(order),
+        "items": [
+            {
+                "name": item.product.name,
+                "price": item.unit_price,
+                "quantity": item.quantity,
+            }
+            for item in order.items.all()
+        ],
+        "total": order.total_price,
+        "payment_deadline": order.payment_deadline,
+    }
+
+
+def get_payment_reminder_context(order):
+    return {
+        "order": str(order),
+        "total": order.total_price,
+        "payment_deadline": order.payment_deadline,
+    }
+
+
+CONTEXTS = {
+    "order_confirmation": get_order_confirmation_context,
+    "payment_reminder": get_payment_reminder_context,
+}
+
+
+def get_order_email(template, order):
+    """
+    Returns the kwargs of tasks.queue_email sending the order's email,
+    None if it is not to be sent anymore (a reminder of a paid order).
+    """
+    if template == "payment_reminder" and order.payment_status == PaymentStatus.PAID:
+        return None
+
+    temp_subject, temp_html, temp_str = TEMPLATES[template]
+    return {
+        "temp_subject": temp_subject,
+        "temp_html": temp_html,
+        "temp_str": temp_str,
+        "context": CONTEXTS[template](order),
+        "recipients": [order.user.email],
+    }
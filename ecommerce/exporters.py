@@ -0,0 +1,65 @@
+import csv
+import io
+import json
+import zlib
+
+FORMATS = ("ndjson", "csv")
+CONTENT_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+CSV_COLUMNS = (
+    "id",
+    "category",
+    "name",
+    "description",
+    "price",
+    "image",
+    "image_min",
+    "updated_at",
+)
+
+
+def _write_csv_row(writer, product):
+    writer.writerow(
+        [
+            product["category"]["name"] if name == "category" else product[name]
+            for name in CSV_COLUMNS
+        ]
+    )
+
+
+def _write_ndjson_row(buffer, product):
+    buffer.write(json.dumps(product, ensure_ascii=False, separators=(",", ":")))
+    buffer.write("\n")
+
+
+def export_products(products, format, chunk_size, compress=False):
+    """
+    Yields the represented products (an iterator) as NDJSON or CSV, in pieces
+    of chunk_size rows, optionally gzip compressed on the fly.
+    Only one piece is held in memory at a time.
+    """
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16) if compress else None
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        data = buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+        return compressor.compress(data) if compressor else data
+
+    if format == "csv":
+        writer.writerow(CSV_COLUMNS)
+
+    for i, product in enumerate(products, start=1):
+        if format == "csv":
+            _write_csv_row(writer, product)
+        else:
+            _write_ndjson_row(buffer, product)
+
+        if i % chunk_size == 0:
+            yield flush()
+
+    yield flush()
+    if compressor:
+        yield compressor.flush()
@@ -0,0 +1,124 @@
+import io
+import os
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image
+
+IMAGE_MIN_SIZE = (200, 200)
+
+# format: (extension, save options)
+RENDITION_FORMATS = {
+    "WEBP": ("webp", {"quality": 80, "method": 4}),
+    "AVIF": ("avif", {"quality": 60, "speed": 8}),
+}
+
+
+def get_rendition_formats():
+    """
+    Returns the configured rendition formats this Pillow build can encode
+    (AVIF requires Pillow >= 11.3 or the pillow-avif-plugin).
+    """
+    Image.init()
+    return [
+        image_format
+        for image_format in settings.PRODUCT_IMAGE_RENDITION_FORMATS
+        if image_format in RENDITION_FORMATS and image_format in Image.SAVE
+    ]
+
+
+def open_image(file, max_width):
+    """
+    Opens the image decoded at the lowest resolution still covering max_width.
+    JPEGs are scaled by the decoder itself (draft mode), so the full-sized
+    bitmap is never allocated. Images above PRODUCT_IMAGE_MAX_PIXELS are refused.
+    """
+    image = Image.open(file)
+
+    pixels = image.width * image.height
+    if pixels > settings.PRODUCT_IMAGE_MAX_PIXELS:
+        raise Image.DecompressionBombError(
+            f"Image size ({pixels} pixels) exceeds limit of "
+            f"{settings.PRODUCT_IMAGE_MAX_PIXELS} pixels."
+        )
+
+    if image.width > max_width:
+        scale = max_width / image.width
+        image.draft("RGB", (max_width, round(image.height * scale)))
+    image.load()
+    return image
+
+
+def _resize(image, width):
+    if image.width <= width:
+        return image
+    height = max(round(image.height * width / image.width), 1)
+    # reducing_gap shrinks by integer factors first, which is much cheaper than LANCZOS alone
+    return image.resize((width, height), Image.LANCZOS, reducing_gap=2.0)
+
+
+def _encode(image, image_format, **options):
+    content = io.BytesIO()
+    image.save(content, format=image_format, **options)
+    return content.getvalue()
+
+
+def _get_mode(image, image_format):
+    has_alpha = image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+    return "RGBA" if has_alpha and image_format != "JPEG" else "RGB"
+
+
+def render_image(file, widths=None, formats=None):
+    """
+    Returns the miniature in the source format and the renditions of the image
+    as [(format, width, content), ...] from the largest to the smallest.
+    The image is decoded once and every size is resized from the next larger one.
+    """
+    widths = sorted(settings.PRODUCT_IMAGE_RENDITION_WIDTHS if widths is None else widths)
+    formats = get_rendition_formats() if formats is None else formats
+    renditions = []
+
+    with open_image(file, max(widths[-1], IMAGE_MIN_SIZE[0])) as image:
+        source_format = image.format
+        # sizes above the source are replaced with the source's
+        if widths[-1] >= image.width:
+            widths = [width for width in widths if width < image.width] + [image.width]
+
+        resized = image
+        for width in reversed(widths):
+            resized = _resize(resized, width)
+            for image_format in formats:
+                rendition = resized.convert(_get_mode(resized, image_format))
+                content = _encode(rendition, image_format, **RENDITION_FORMATS[image_format][1])
+                renditions.append((image_format, resized.width, content))
+
+        min_image = resized.convert(_get_mode(resized, source_format))
+        min_image.thumbnail(IMAGE_MIN_SIZE, Image.LANCZOS)
+        miniature = _encode(min_image, source_format)
+
+    return miniature, renditions
+
+
+def create_renditions(image_name, min_directory, renditions_directory):
+    """
+    Creates the miniature and the renditions of the image stored under image_name.
+    Returns the miniature's name and the renditions as {format: [[width, name], ...]}
+    ordered by width.
+    """
+    with default_storage.open(image_name) as file:
+        miniature, rendered = render_image(file)
+
+    basename = os.path.basename(image_name)
+    image_min = default_storage.save(min_directory + basename, ContentFile(miniature))
+
+    stem = os.path.splitext(basename)[0]
+    renditions = {}
+    for image_format, width, content in reversed(rendered):
+        extension = RENDITION_FORMATS[image_format][0]
+        name = default_storage.save(
+            f"{renditions_directory}{stem}-{width}w.{extension}", ContentFile(content)
+        )
+        renditions.setdefault(extension, []).append([width, name])
+
+    return image_min, renditions
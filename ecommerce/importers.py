@@ -0,0 +1,158 @@
+import codecs
+import csv
+import json
+import os
+import time
+import zipfile
+from functools import partial
+from itertools import islice
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import transaction
+from rest_framework import serializers
+
+from ecommerce import tasks
+from ecommerce.api.serializers import ProductImportSerializer
+from ecommerce.cache import bump_catalogue_version
+from ecommerce.models import Product, ProductCategory
+
+FORMATS = ("csv", "jsonl")
+
+
+def get_format(filename):
+    extension = os.path.splitext(filename or "")[1].lower()
+    return "jsonl" if extension in [".jsonl", ".ndjson"] else "csv"
+
+
+def decode_lines(file, invalid):
+    """
+    Lazily decodes the lines of a binary UTF-8 stream (with or without a BOM).
+    Numbers of the lines that are not valid UTF-8 are added to invalid.
+    """
+    for number, line in enumerate(file, start=1):
+        if number == 1:
+            line = line.removeprefix(codecs.BOM_UTF8)
+        try:
+            yield line.decode("utf-8")
+        except UnicodeDecodeError:
+            invalid.add(number)
+            yield line.decode("utf-8", "replace")
+
+
+def read_rows(file, format):
+    """
+    Lazily yields (line number, row) pairs from a binary CSV or JSON Lines stream.
+    Rows that can not be decoded or parsed are yielded as None.
+    """
+    invalid = set()
+    lines = decode_lines(file, invalid)
+
+    if format == "csv":
+        reader = csv.DictReader(lines)
+        reader.fieldnames  # reads the header
+        first_line = reader.line_num + 1
+        for row in reader:
+            # a quoted value can span several lines
+            spanned = range(first_line, reader.line_num + 1)
+            yield reader.line_num, None if invalid.intersection(spanned) else row
+            first_line = reader.line_num + 1
+        return
+
+    for number, line in enumerate(lines, start=1):
+        if number in invalid:
+            yield number, None
+            continue
+        if not line.strip():
+            continue
+        try:
+            yield number, json.loads(line)
+        except ValueError:
+            yield number, None
+
+
+class ProductImport:
+    """
+    Imports products from a stream in chunks: each chunk is validated, inserted with
+    bulk_create and committed, then its miniatures are queued for the workers.
+    Invalid rows are reported and skipped without aborting the import.
+
+    Images are paths of files in the media storage or members of the given zip archive.
+    Categories are given by their names (case insensitive) or ids.
+    """
+
+    def __init__(self, archive=None, chunk_size=None):
+        self.archive = zipfile.ZipFile(archive) if archive else None
+        self.archive_members = set(self.archive.namelist()) if self.archive else set()
+        self.chunk_size = chunk_size or settings.PRODUCT_IMPORT_CHUNK_SIZE
+
+        self.categories = {}
+        for category_id, name in ProductCategory.objects.values_list("id", "name"):
+            self.categories[str(category_id)] = category_id
+            self.categories[name.lower()] = category_id
+
+        self.created = 0
+        self.errors = []
+
+    def run(self, file, format):
+        start = time.monotonic()
+
+        rows = read_rows(file, format)
+        while chunk := list(islice(rows, self.chunk_size)):
+            self._import_chunk(chunk)
+
+        return {
+            "created": self.created,
+            "errors": self.errors,
+            "seconds": round(time.monotonic() - start, 3),
+        }
+
+    def _store_image(self, name):
+        if name not in self.archive_members:
+            return name
+
+        with self.archive.open(name) as member:
+            return default_storage.save(
+                Product.IMAGE_FULL_DIR + os.path.basename(name), File(member)
+            )
+
+    def _import_chunk(self, chunk):
+        serializer = ProductImportSerializer(
+            context={"categories": self.categories, "archive_members": self.archive_members}
+        )
+
+        products = []
+        for line, row in chunk:
+            if not isinstance(row, dict):
+                self.errors.append({"line": line, "errors": ["Invalid row."]})
+                continue
+
+            try:
+                data = serializer.run_validation(row)
+            except serializers.ValidationError as e:
+                self.errors.append({"line": line, "errors": e.detail})
+                continue
+
+            products.append(
+                Product(
+                    name=data["name"],
+                    description=data.get("description"),
+                    price=data["price"],
+                    category_id=data["category"],
+                    image=self._store_image(data["image"]),
+                )
+            )
+
+        if not products:
+            return
+
+        with transaction.atomic():
+            products = Product.objects.bulk_create(products)
+            # the chunk is visible as soon as it is committed
+            transaction.on_commit(bump_catalogue_version)
+            transaction.on_commit(
+                partial(tasks.queue_images_min, [product.pk for product in products])
+            )
+
+        self.created += len(products)
@@ -0,0 +1,116 @@
+import socketserver
+import threading
+import time
+
+from django.core import mail
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from ecommerce import delivery
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Speaks just enough SMTP for smtplib: every command is accepted and the messages
+    are counted, not stored.
+    """
+
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode("ascii"))
+
+    def handle(self):
+        # stands for the TCP, TLS and authentication round trips of a real server
+        time.sleep(self.server.connect_latency)
+        self.reply("220 localhost SMTP stand-in")
+
+        while line := self.rfile.readline():
+            command = line.decode("ascii", "replace").strip().upper()
+            if command == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                while self.rfile.readline() not in (b".\r\n", b""):
+                    pass
+                with self.server.lock:
+                    self.server.received += 1
+                self.reply("250 OK")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:  # EHLO, MAIL, RCPT, RSET, NOOP
+                self.reply("250 OK")
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+    def __init__(self, connect_latency=0):
+        super().__init__(("127.0.0.1", 0), SMTPHandler)
+        self.connect_latency = connect_latency
+        self.lock = threading.Lock()
+        self.received = 0
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the emails sent per second to a local SMTP stand-in with a connection "
+        "per email (as Django's send_mail) and with the pooled connection of the workers."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--count", type=int, default=200, help="Number of emails.")
+        parser.add_argument(
+            "--connect-latency",
+            type=float,
+            default=0.05,
+            help="Seconds the stand-in takes to accept a connection.",
+        )
+
+    def _send_each(self, messages):
+        for message in messages:
+            mail.get_connection().send_messages([message])
+        return []
+
+    def _send_pooled(self, messages):
+        try:
+            return delivery.send_messages(messages)
+        finally:
+            delivery.close_connection()
+
+    def handle(self, *args, **options):
+        messages = delivery.build_messages(
+            "Order #0001",
+            "Thank you for your order.",
+            "<p>Thank you for your order.</p>",
+            [f"customer{i}@mail.com" for i in range(options["count"])],
+        )
+
+        with SMTPStandIn(options["connect_latency"]) as server, override_settings(
+            EMAIL_BACKEND="django.core.mail.backends.smtp.EmailBackend",
+            EMAIL_HOST=server.server_address[0],
+            EMAIL_PORT=server.server_address[1],
+            EMAIL_HOST_USER="",
+            EMAIL_HOST_PASSWORD="",
+            EMAIL_USE_TLS=False,
+            EMAIL_USE_SSL=False,
+        ):
+            for label, send in [
+                ("connection per email", self._send_each),
+                ("pooled connection", self._send_pooled),
+            ]:
+                server.received = 0
+                start = time.perf_counter()
+                failed = send(messages)
+                elapsed = time.perf_counter() - start
+
+                if failed or server.received != len(messages):
+                    raise CommandError(
+                        f"{label}: {server.received} of {len(messages)} emails received."
+                    )
+                self.stdout.write(f"{label}: {len(messages) / elapsed:.0f} emails/s")
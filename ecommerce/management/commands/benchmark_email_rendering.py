@@ -0,0 +1,78 @@
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from ecommerce import emails
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the emails rendered per second with render_to_string and the compiled templates."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--count", type=int, default=1000, help="Number of emails.")
+        parser.add_argument("--items", type=int, default=5, help="Items per order.")
+        parser.add_argument("--repeat", type=int, default=5, help="Runs, the best is reported.")
+        parser.add_argument(
+            "--template", default="order_confirmation", choices=sorted(emails.TEMPLATES)
+        )
+
+    def _get_contexts(self, options):
+        items = [
+            {"name": f"Product {i}", "price": Decimal("19.99"), "quantity": i + 1}
+            for i in range(options["items"])
+        ]
+        return [
+            {
+                "order": f"Order #{str(i).zfill(4)}",
+                "items": items,
+                "total": Decimal("19.99") * len(items),
+                "payment_deadline": timezone.now(),
+            }
+            for i in range(options["count"])
+        ]
+
+    def _measure(self, render):
+        start = time.perf_counter()
+        rendered = render()
+        return rendered, time.perf_counter() - start
+
+    def handle(self, *args, **options):
+        temp_subject, temp_html, temp_str = emails.TEMPLATES[options["template"]]
+        contexts = self._get_contexts(options)
+
+        def render_each():
+            return [
+                (
+                    render_to_string(temp_subject).replace("\n", ""),
+                    render_to_string(temp_str, context),
+                    render_to_string(temp_html, context),
+                )
+                for context in contexts
+            ]
+
+        def render_compiled():
+            subject = emails.render_subject(temp_subject)
+            texts = emails.render_many(temp_str, contexts)
+            htmls = emails.render_many(temp_html, contexts)
+            return [(subject, text, html) for text, html in zip(texts, htmls)]
+
+        # alternated, so that both run in the same conditions
+        timings = {"render_to_string": [], "compiled templates": []}
+        for _ in range(options["repeat"]):
+            before, elapsed = self._measure(render_each)
+            timings["render_to_string"].append(elapsed)
+            after, elapsed = self._measure(render_compiled)
+            timings["compiled templates"].append(elapsed)
+
+            if before != after:
+                raise CommandError("The compiled templates rendered different emails.")
+
+        for label, elapsed in timings.items():
+            self.stdout.write(f"{label}: {len(contexts) / min(elapsed):.0f} emails/s")
+
+        self.stdout.write(self.style.SUCCESS("Both rendered the same emails."))
@@ -0,0 +1,67 @@
+import re
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q
+
+from ecommerce.api.filters import filter_products
+from ecommerce.models import Product
+
+INDEX_SCAN = re.compile(r"Index (?:Only )?Scan (?:Backward )?(?:using|on) (\w+)")
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure product searches of both names and descriptions: icontains without indexes "
+        "(as before the search indexes), icontains with the trigram indexes and q= full-text."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "terms", nargs="*", default=["laptop", "wireless mouse", "usb"], help="Search terms."
+        )
+        parser.add_argument("--repeat", type=int, default=5, help="Runs, the best is reported.")
+        parser.add_argument("--page-size", type=int, default=10)
+
+    def _get_paths(self, term):
+        icontains = Product.objects.filter(
+            Q(name__icontains=term) | Q(description__icontains=term)
+        ).order_by("pk")
+        return [
+            ("icontains, indexes disabled", icontains, False),
+            ("icontains", icontains, True),
+            ("q", filter_products(Product.objects.all(), {"q": term}), True),
+        ]
+
+    def _measure(self, queryset, use_indexes, repeat, page_size):
+        """
+        Returns the best time of fetching the first page and the indexes of its plan.
+        """
+        with transaction.atomic(), connection.cursor() as cursor:
+            if not use_indexes:
+                cursor.execute("SET LOCAL enable_indexscan = off")
+                cursor.execute("SET LOCAL enable_bitmapscan = off")
+
+            page = queryset.values_list("pk", flat=True)[:page_size]
+            indexes = sorted(set(INDEX_SCAN.findall(page.explain())))
+
+            elapsed = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                list(page.all())  # a clone, not the cached results
+                elapsed.append(time.perf_counter() - start)
+
+        return min(elapsed), indexes
+
+    def handle(self, *args, **options):
+        count = Product.objects.count()
+        self.stdout.write(f"{count} products")
+
+        for term in options["terms"]:
+            for label, queryset, use_indexes in self._get_paths(term):
+                elapsed, indexes = self._measure(
+                    queryset, use_indexes, options["repeat"], options["page_size"]
+                )
+                plan = ", ".join(indexes) or "no index"
+                self.stdout.write(f"{term!r} {label}: {elapsed * 1000:.1f}ms ({plan})")
@@ -0,0 +1,60 @@
+import time
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from ecommerce.images import get_rendition_formats, render_image
+from ecommerce.models import Product
+
+
+class Command(BaseCommand):
+    help = "Measure the encode time and size of image renditions compared to the originals."
+
+    def add_arguments(self, parser):
+        parser.add_argument("paths", nargs="*", help="Images to render, defaults to products'.")
+        parser.add_argument("--limit", type=int, default=20, help="Number of product images.")
+
+    def _get_images(self, options):
+        for path in options["paths"]:
+            yield path, open(path, "rb")
+
+        if not options["paths"]:
+            names = Product.objects.order_by("pk").values_list("image", flat=True)
+            for name in names[: options["limit"]]:
+                yield name, default_storage.open(name)
+
+    def handle(self, *args, **options):
+        formats = get_rendition_formats()
+        totals = {image_format: [0, 0.0] for image_format in formats}
+        original_total = 0
+
+        for name, file in self._get_images(options):
+            with file:
+                original = file.size if hasattr(file, "size") else len(file.read())
+                original_total += original
+                results = []
+
+                for image_format in formats:
+                    file.seek(0)
+                    start = time.perf_counter()
+                    miniature, renditions = render_image(file, formats=[image_format])
+                    elapsed = time.perf_counter() - start
+
+                    largest = renditions[0][2]
+                    totals[image_format][0] += len(largest)
+                    totals[image_format][1] += elapsed
+                    results.append(
+                        f"{image_format} {elapsed * 1000:.0f}ms "
+                        f"{len(largest)}B ({1 - len(largest) / original:.0%} saved)"
+                    )
+
+            self.stdout.write(f"{name} {original}B: " + ", ".join(results))
+
+        for image_format, (size, seconds) in totals.items():
+            saved = original_total - size
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"{image_format}: {seconds:.2f}s encoding, "
+                    f"{saved}B saved on the largest renditions"
+                )
+            )
@@ -0,0 +1,78 @@
+from datetime import timedelta
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from ecommerce.models import Product, UploadSession, UploadStatus
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete product images, miniatures and renditions no product refers to "
+        "and abandoned upload sessions."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Only list the files.")
+        parser.add_argument(
+            "--grace-hours",
+            type=int,
+            default=24,
+            help="Keep files younger than this, they may belong to a pending upload or task.",
+        )
+
+    def _walk(self, directory):
+        try:
+            directories, files = default_storage.listdir(directory)
+        except FileNotFoundError:
+            return
+
+        for name in files:
+            yield directory + name
+        for subdirectory in directories:
+            yield from self._walk(f"{directory}{subdirectory}/")
+
+    def _get_referenced(self):
+        referenced = set()
+        products = Product.objects.values_list("image", "image_min", "renditions")
+        for image, image_min, renditions in products.iterator(chunk_size=2000):
+            referenced.update((image, image_min))
+            for sizes in renditions.values():
+                referenced.update(name for width, name in sizes)
+
+        # finished uploads not attached to a product yet
+        referenced.update(UploadSession.objects.exclude(image="").values_list("image", flat=True))
+        return referenced
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(hours=options["grace_hours"])
+        referenced = self._get_referenced()
+
+        deleted = size = 0
+        directories = Product.IMAGE_FULL_DIR, Product.IMAGE_MINI_DIR, Product.IMAGE_RENDITIONS_DIR
+        for directory in directories:
+            for name in self._walk(directory):
+                if name in referenced or default_storage.get_modified_time(name) > cutoff:
+                    continue
+
+                deleted += 1
+                size += default_storage.size(name)
+                self.stdout.write(name)
+                if not options["dry_run"]:
+                    default_storage.delete(name)
+
+        sessions = UploadSession.objects.filter(created_at__lt=cutoff)
+        abandoned = sessions.filter(status=UploadStatus.OPEN)
+        for session in abandoned:
+            deleted += 1
+            size += session.offset
+            self.stdout.write(session.part_path)
+            if not options["dry_run"]:
+                session.delete_part()
+        if not options["dry_run"]:
+            # completed sessions are kept for the grace period to be attached to products
+            sessions.delete()
+
+        action = "would be deleted" if options["dry_run"] else "deleted"
+        self.stdout.write(self.style.SUCCESS(f"{deleted} files ({size} bytes) {action}."))
@@ -0,0 +1,43 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand
+
+from ecommerce.importers import FORMATS, ProductImport, get_format
+
+
+class Command(BaseCommand):
+    help = "Import products from a CSV or JSON Lines file."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="CSV or JSON Lines file, '-' for stdin.")
+        parser.add_argument("--format", choices=FORMATS, help="Defaults to the file's extension.")
+        parser.add_argument("--archive", help="Zip archive with the products' images.")
+        parser.add_argument("--chunk-size", type=int)
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        format = options["format"] or get_format(path)
+
+        product_import = ProductImport(
+            archive=options["archive"], chunk_size=options["chunk_size"]
+        )
+
+        if path == "-":
+            report = product_import.run(sys.stdin.buffer, format)
+        else:
+            with open(path, "rb") as file:
+                report = product_import.run(file, format)
+
+        for error in report["errors"]:
+            self.stdout.write(
+                self.style.WARNING(f"Line {error['line']}: {json.dumps(error['errors'])}")
+            )
+
+        rate = report["created"] / report["seconds"] if report["seconds"] else 0
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{report['created']} products imported, {len(report['errors'])} rows skipped "
+                f"in {report['seconds']}s ({rate:.0f} products/s)."
+            )
+        )
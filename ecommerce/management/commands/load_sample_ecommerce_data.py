@@ -1,15 +1,16 @@
-import os
 import random
 
 import requests
-from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
 from django.core.management.base import BaseCommand
 from django_countries import countries
 from faker import Faker
 
 from core.models import Role
 from ecommerce.models import Order, OrderItem, Product, ProductCategory, ShippingAddress
+from ecommerce.tasks import create_images_min
 
 User = get_user_model()
 fake = Faker()
@@ -41,16 +42,10 @@ class Command(BaseCommand):
         url = fake.image_url(width=width, height=height)
         image_response = requests.get(url)
 
-        filename = f"{fake.word()}.png"
-
-        if not os.path.exists(settings.MEDIA_URL[1:] + Product.IMAGE_FULL_DIR):
-            os.makedirs(settings.MEDIA_URL[1:] + Product.IMAGE_FULL_DIR)
-
-        # [1:] removes the '/' at the beginning
-        with open(settings.MEDIA_URL[1:] + Product.IMAGE_FULL_DIR + filename, "wb") as image_file:
-            image_file.write(image_response.content)
-
-        return Product.IMAGE_FULL_DIR + filename
+        # stored under the hash of the content, so random words can not collide
+        return default_storage.save(
+            Product.IMAGE_FULL_DIR + "sample.png", ContentFile(image_response.content)
+        )
 
     def _load_products(self, categories, n=1):
         if Product.objects.exists():
@@ -71,8 +66,9 @@ class Command(BaseCommand):
                 )
                 for i in range(1, n + 1)
             ]
-            for product in products:
-                product.save()
+            # the miniatures are created right away instead of on the images queue
+            products = Product.objects.bulk_create(products)
+            create_images_min([product.pk for product in products])
 
         self.stdout.write(self.style.SUCCESS("Sample products loaded."))
 
@@ -84,17 +80,22 @@ class Command(BaseCommand):
 
         for user in User.objects.filter(role=Role.CUSTOMER):
             for _ in range(1, n + 1):
-                order = Order.objects.create(
-                    user=user, shipping_address=user.shipping_addresses.last()
-                )
-
                 products = Product.objects.all().order_by("?")
-                OrderItem.objects.create(
-                    order=order, product=products.first(), quantity=random.randint(1, 3)
-                )
-                OrderItem.objects.create(
-                    order=order, product=products.last(), quantity=random.randint(1, 3)
+                items = [
+                    OrderItem(
+                        product=product, quantity=random.randint(1, 3), unit_price=product.price
+                    )
+                    for product in [products.first(), products.last()]
+                ]
+
+                order = Order.objects.create(
+                    user=user,
+                    shipping_address=user.shipping_addresses.last(),
+                    total_price=Order.calculate_total_price(items),
                 )
+                for item in items:
+                    item.order = order
+                OrderItem.objects.bulk_create(items)
 
         self.stdout.write(self.style.SUCCESS("Sample orders loaded."))
 
@@ -0,0 +1,143 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.utils import timezone
+
+from ecommerce import images
+from ecommerce.cache import bump_catalogue_version
+from ecommerce.models import ImageStatus, Product
+from ecommerce.tasks import CORRUPT_IMAGE_ERRORS, save_renditions
+
+
+def regenerate(product_id, image_name, dry_run):
+    """
+    Runs in the pool's processes. Returns the product's new miniature fields
+    and the size of the source image.
+    """
+    image_min, renditions, status = "", {}, ImageStatus.READY
+    try:
+        size = default_storage.size(image_name)
+        if dry_run:
+            with default_storage.open(image_name) as file:
+                images.render_image(file)
+        else:
+            image_min, renditions = images.create_renditions(
+                image_name, Product.IMAGE_MINI_DIR, Product.IMAGE_RENDITIONS_DIR
+            )
+    except (OSError, *CORRUPT_IMAGE_ERRORS):
+        size, status = 0, ImageStatus.FAILED
+
+    return (
+        Product(
+            pk=product_id,
+            image=image_name,
+            image_min=image_min,
+            renditions=renditions,
+            image_min_status=status,
+        ),
+        size,
+    )
+
+
+class Command(BaseCommand):
+    help = "Regenerate miniatures and renditions of product images on a process pool."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+        # the CPUs the command may run on (ex. limited by the container), not the machine's
+        parser.add_argument("--workers", type=int, default=len(os.sched_getaffinity(0)))
+        parser.add_argument(
+            "--status", choices=ImageStatus.values, help="Only products with this status."
+        )
+        parser.add_argument(
+            "--checkpoint",
+            default=".regenerate_thumbnails",
+            help="File keeping the last processed pk, the command resumes after it.",
+        )
+        parser.add_argument(
+            "--dry-run", action="store_true", help="Render in memory without saving anything."
+        )
+
+    def _read_checkpoint(self, path):
+        try:
+            with open(path) as file:
+                return int(file.read())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _write_checkpoint(self, path, last_pk):
+        with open(path + ".tmp", "w") as file:
+            file.write(str(last_pk))
+        os.replace(path + ".tmp", path)
+
+    def handle(self, *args, **options):
+        batch_size, dry_run, checkpoint = options["batch_size"], options["dry_run"], None
+        if not dry_run:
+            checkpoint = options["checkpoint"]
+
+        last_pk = self._read_checkpoint(checkpoint) if checkpoint else 0
+        if last_pk:
+            self.stdout.write(f"Resuming after product {last_pk}.")
+
+        products = Product.objects.order_by("pk")
+        if options["status"]:
+            products = products.filter(image_min_status=options["status"])
+
+        processed = failed = total_size = 0
+        start = time.monotonic()
+
+        # the forked processes must not share the parent's connections
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=options["workers"]) as executor:
+            while True:
+                batch = list(
+                    products.filter(pk__gt=last_pk).values_list("pk", "image")[:batch_size]
+                )
+                if not batch:
+                    break
+
+                ids, names = zip(*batch)
+                chunksize = max(len(batch) // (options["workers"] * 4), 1)
+                results = list(
+                    executor.map(regenerate, ids, names, repeat(dry_run), chunksize=chunksize)
+                )
+
+                if not dry_run:
+                    now = timezone.now()
+                    for product, size in results:
+                        product.updated_at = now
+                    # products whose image was replaced meanwhile are left to its own task
+                    if save_renditions([product for product, size in results]):
+                        bump_catalogue_version()
+
+                last_pk = ids[-1]
+                if checkpoint:
+                    self._write_checkpoint(checkpoint, last_pk)
+
+                processed += len(results)
+                failed += sum(
+                    product.image_min_status == ImageStatus.FAILED for product, size in results
+                )
+                total_size += sum(size for product, size in results)
+                stats = self._get_stats(processed, failed, total_size, start)
+                self.stdout.write(f"{stats}, last pk {last_pk}")
+
+        if checkpoint and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+
+        stats = self._get_stats(processed, failed, total_size, start)
+        self.stdout.write(self.style.SUCCESS(stats))
+
+    def _get_stats(self, processed, failed, size, start):
+        seconds = time.monotonic() - start
+        images_rate = processed / seconds if seconds else 0
+        mb_rate = size / 2**20 / seconds if seconds else 0
+        return (
+            f"{processed} images ({failed} failed) in {seconds:.1f}s: "
+            f"{images_rate:.1f} images/s, {mb_rate:.2f} MB/s"
+        )
@@ -0,0 +1,38 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from kombu.exceptions import OperationalError
+
+from ecommerce import outbox
+
+
+class Command(BaseCommand):
+    help = "Publish the outbox messages to the Celery broker."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=settings.OUTBOX_BATCH_SIZE)
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=settings.OUTBOX_RELAY_INTERVAL,
+            help="Seconds to wait when the outbox is empty.",
+        )
+        parser.add_argument("--once", action="store_true", help="Drain the outbox and exit.")
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                published = outbox.relay(options["batch_size"])
+            except (OperationalError, OSError) as exc:
+                # the broker is unavailable, the messages stay in the outbox
+                self.stderr.write(f"Publishing failed: {exc}")
+                time.sleep(options["interval"])
+                continue
+
+            if published:
+                self.stdout.write(f"{published} messages published.")
+            elif options["once"]:
+                return
+            else:
+                time.sleep(options["interval"])
@@ -0,0 +1,23 @@
+# Generated by Django 4.2 on 2026-10-18 16:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ecommerce', '0004_product_list_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='image_min_status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('ready', 'Ready'), ('failed', 'Failed')], default='pending', max_length=7),
+        ),
+        # miniatures of the existing products were created inline by Product.save()
+        migrations.RunSQL(
+            "UPDATE ecommerce_product SET image_min_status = 'ready' WHERE image_min <> ''",
+            migrations.RunSQL.noop,
+        ),
+    ]
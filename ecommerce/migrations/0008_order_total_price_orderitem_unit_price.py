@@ -0,0 +1,47 @@
+# Generated by Django 4.2 on 2026-10-18 17:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ecommerce', '0007_uploadsession'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='total_price',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='unit_price',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=6),
+            preserve_default=False,
+        ),
+        # the history has no price snapshots, the current prices are the best approximation
+        migrations.RunSQL(
+            """
+            UPDATE ecommerce_orderitem AS item
+            SET unit_price = product.price
+            FROM ecommerce_product AS product
+            WHERE product.id = item.product_id
+            """,
+            migrations.RunSQL.noop,
+        ),
+        migrations.RunSQL(
+            """
+            UPDATE ecommerce_order AS "order"
+            SET total_price = totals.total_price
+            FROM (
+                SELECT order_id, SUM(unit_price * quantity) AS total_price
+                FROM ecommerce_orderitem
+                GROUP BY order_id
+            ) AS totals
+            WHERE totals.order_id = "order".id
+            """,
+            migrations.RunSQL.noop,
+        ),
+    ]
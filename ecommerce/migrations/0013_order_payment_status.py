@@ -0,0 +1,32 @@
+# Generated by Django 4.2 on 2026-10-18 17:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ecommerce', '0012_outboxmessage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='payment_status',
+            field=models.CharField(choices=[('unpaid', 'Unpaid'), ('paid', 'Paid')], default='unpaid', max_length=6),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='reminder_sent_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        # reminders of the existing orders were already scheduled with an ETA
+        migrations.RunSQL(
+            "UPDATE ecommerce_order SET reminder_sent_at = created_at",
+            migrations.RunSQL.noop,
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(('payment_status', 'unpaid'), ('reminder_sent_at__isnull', True)), fields=['payment_deadline'], name='order_reminder_due_idx'),
+        ),
+    ]
@@ -1,14 +1,23 @@
 import os
+import tempfile
+import uuid
 from datetime import timedelta
+from decimal import Decimal
+from functools import partial
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.contrib.postgres.indexes import GinIndex, OpClass
+from django.contrib.postgres.search import SearchVectorField
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.validators import MinValueValidator
-from django.db import models
+from django.db import models, transaction
+from django.db.models.functions import Upper
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django_countries.fields import CountryField
-from PIL import Image
+
+from ecommerce import images
 
 User = get_user_model()
 
@@ -36,6 +45,12 @@ class ProductCategory(models.Model):
         return self.name
 
 
+class ImageStatus(models.TextChoices):
+    PENDING = ("pending", _("Pending"))
+    READY = ("ready", _("Ready"))
+    FAILED = ("failed", _("Failed"))
+
+
 class Product(models.Model):
     name = models.CharField(max_length=100)
     description = models.TextField(null=True, blank=True)
@@ -45,48 +60,166 @@ class Product(models.Model):
     category = models.ForeignKey(
         ProductCategory, on_delete=models.PROTECT, related_name="products"
     )
+    # units available for orders, products without it are not tracked
+    stock = models.PositiveIntegerField(null=True, blank=True)
 
     IMAGE_FULL_DIR = "full/"
     IMAGE_MINI_DIR = "mini/"
+    IMAGE_RENDITIONS_DIR = "renditions/"
 
     image = models.ImageField(upload_to=IMAGE_FULL_DIR)
     image_min = models.ImageField(upload_to=IMAGE_MINI_DIR, blank=True)
+    image_min_status = models.CharField(
+        max_length=7, choices=ImageStatus.choices, default=ImageStatus.PENDING
+    )
+    # {"webp": [[width, name], ...], ...} ordered by width
+    renditions = models.JSONField(default=dict, blank=True, editable=False)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    # maintained by a database trigger from name (weight A) and description (weight B)
+    SEARCH_CONFIG = "english"
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # filter + order combinations of the product list
+            models.Index(fields=["category", "price"], name="product_category_price_idx"),
+            models.Index(fields=["category", "name"], name="product_category_name_idx"),
+            models.Index(fields=["price", "id"], name="product_price_id_idx"),
+            GinIndex(fields=["search_vector"], name="product_search_vector_idx"),
+            # trigram indexes matching the UPPER(...) LIKE UPPER(...) of icontains lookups
+            GinIndex(OpClass(Upper("name"), name="gin_trgm_ops"), name="product_name_trgm_idx"),
+            GinIndex(
+                OpClass(Upper("description"), name="gin_trgm_ops"), name="product_desc_trgm_idx"
+            ),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if "image" in field_names:
+            instance._loaded_image_name = values[field_names.index("image")]
+        return instance
 
-    def create_image_min(self):
+    def create_renditions(self):
         """
-        Creating miniature image based on the full-sized pic
+        Creating the miniature and the responsive renditions based on the full-sized pic
         """
-        if not os.path.exists(settings.MEDIA_URL[1:] + self.IMAGE_MINI_DIR):
-            os.makedirs(settings.MEDIA_URL[1:] + self.IMAGE_MINI_DIR)
+        self.image_min, self.renditions = images.create_renditions(
+            self.image.name, self.IMAGE_MINI_DIR, self.IMAGE_RENDITIONS_DIR
+        )
 
-        open_path = settings.MEDIA_URL[1:] + self.IMAGE_FULL_DIR + self.image.name
-        if self.IMAGE_FULL_DIR in self.image.name:
-            open_path = settings.MEDIA_URL[1:] + self.image.name
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        # a new file has been uploaded (or the product is new): its miniature
+        # and renditions are created in the background by the images worker
+        if update_fields is not None and "image" not in update_fields:
+            image_changed = False
+        elif not self._state.adding and "image" in self.get_deferred_fields():
+            image_changed = False  # neither loaded, with only()/defer(), nor assigned
+        else:
+            image_changed = self.image.name != getattr(self, "_loaded_image_name", None)
 
-        with Image.open(open_path) as full_image:
-            min_image = full_image.resize((200, 200), Image.ANTIALIAS)
+        if image_changed:
+            self.image_min, self.renditions = "", {}
+            self.image_min_status = ImageStatus.PENDING
 
-            if self.IMAGE_FULL_DIR in self.image.name:
-                min_image.save("media/" + self.IMAGE_MINI_DIR + self.image.name.split("/")[1])
-                self.image_min = self.IMAGE_MINI_DIR + self.image.name.split("/")[1]
-            else:
-                min_image.save("media/" + self.IMAGE_MINI_DIR + self.image.name)
-                self.image_min = self.IMAGE_MINI_DIR + self.image.name
+        super().save(force_insert, force_update, using, update_fields)
+        if "image" not in self.get_deferred_fields():
+            self._loaded_image_name = self.image.name
 
-    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
-        # create a new image file if has not been created yet or a new file has been uploaded
-        create_min_image = (
-            not self.image.name == self.image_min.name.split("/")[1] if self.image_min else True
-        )
-        if create_min_image:
-            self.create_image_min()
+        if image_changed:
+            from ecommerce import tasks
 
-        return super().save(force_insert, force_update, using, update_fields)
+            transaction.on_commit(partial(tasks.create_image_min.delay, self.pk))
 
     def __str__(self):
         return self.name
 
 
+class UploadStatus(models.TextChoices):
+    OPEN = ("open", _("Open"))
+    COMPLETE = ("complete", _("Complete"))
+
+
+def _copy_bytes(source, target, length, buffer_size):
+    """
+    Copies up to length bytes, returns the number copied (less if source ends first).
+    """
+    remaining = length
+    while remaining:
+        chunk = source.read(min(buffer_size, remaining))
+        if not chunk:
+            break
+        target.write(chunk)
+        remaining -= len(chunk)
+    return length - remaining
+
+
+class UploadSession(models.Model):
+    """
+    Resumable upload of a product image. Chunks are appended to a part file
+    outside of the media storage, on completion the image is moved to the storage
+    and can be attached to products by the session's id.
+    """
+
+    CHUNK_BUFFER_SIZE = 64 * 2**10
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="upload_sessions")
+    filename = models.CharField(max_length=100)
+    size = models.PositiveBigIntegerField()
+    offset = models.PositiveBigIntegerField(default=0)
+    status = models.CharField(
+        max_length=8, choices=UploadStatus.choices, default=UploadStatus.OPEN
+    )
+    image = models.CharField(max_length=100, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @property
+    def part_path(self):
+        return os.path.join(settings.PRODUCT_UPLOAD_TEMP_DIR, f"{self.pk}.part")
+
+    def receive_chunk(self, stream, length):
+        """
+        Streams up to length bytes of a chunk from the client into a temporary file,
+        so that the session does not have to be locked meanwhile.
+        Returns the file, to be passed to write_chunk() and closed.
+        """
+        os.makedirs(settings.PRODUCT_UPLOAD_TEMP_DIR, exist_ok=True)
+        chunk = tempfile.TemporaryFile(dir=settings.PRODUCT_UPLOAD_TEMP_DIR)
+        _copy_bytes(stream, chunk, length, self.CHUNK_BUFFER_SIZE)
+        chunk.seek(0)
+        return chunk
+
+    def write_chunk(self, stream, offset, length):
+        """
+        Streams length bytes into the part file at the given offset, overwriting
+        whatever was received after it (a retried chunk), and returns the new offset.
+        """
+        os.makedirs(settings.PRODUCT_UPLOAD_TEMP_DIR, exist_ok=True)
+        with open(self.part_path, "r+b" if offset else "wb") as part:
+            part.seek(offset)
+            part.truncate()
+            written = _copy_bytes(stream, part, length, self.CHUNK_BUFFER_SIZE)
+
+        self.offset = offset + written
+        return self.offset
+
+    def delete_part(self):
+        try:
+            os.remove(self.part_path)
+        except FileNotFoundError:
+            pass
+
+    def __str__(self):
+        return f"{self.filename} ({self.offset}/{self.size})"
+
+
+class PaymentStatus(models.TextChoices):
+    UNPAID = ("unpaid", _("Unpaid"))
+    PAID = ("paid", _("Paid"))
+
+
 class Order(models.Model):
     user = models.ForeignKey(User, on_delete=models.PROTECT, related_name="orders")
     shipping_address = models.ForeignKey(
@@ -94,6 +227,24 @@ class Order(models.Model):
     )
     created_at = models.DateTimeField(blank=True)
     payment_deadline = models.DateTimeField(blank=True)
+    # sum of the items' unit prices times quantities, stored on creation
+    total_price = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    payment_status = models.CharField(
+        max_length=6, choices=PaymentStatus.choices, default=PaymentStatus.UNPAID
+    )
+    reminder_sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # order history of a customer
+            models.Index(fields=["user", "created_at"], name="order_user_created_at_idx"),
+            # orders due a payment reminder, see tasks.send_payment_reminders
+            models.Index(
+                fields=["payment_deadline"],
+                condition=models.Q(payment_status="unpaid", reminder_sent_at__isnull=True),
+                name="order_reminder_due_idx",
+            ),
+        ]
 
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
         if not self.created_at:
@@ -104,15 +255,67 @@ class Order(models.Model):
     def __str__(self):
         return _("Order") + f" #{str(self.pk).zfill(4)}"
 
-    @property
-    def total_price(self):
-        return sum([item.product.price for item in self.items.all()])
+    @staticmethod
+    def calculate_total_price(items):
+        return sum((item.unit_price * item.quantity for item in items), Decimal(0))
 
 
 class OrderItem(models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name="items")
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="items")
     quantity = models.PositiveSmallIntegerField(default=1)
+    # the product's price when the order was placed
+    unit_price = models.DecimalField(max_digits=6, decimal_places=2)
 
     def __str__(self):
         return f"[{self.order}] {self.product} x{self.quantity}"
+
+
+class IdempotencyKey(models.Model):
+    """
+    Response of a request sent with an Idempotency-Key header, replayed to its retries.
+    """
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="idempotency_keys")
+    key = models.CharField(max_length=255)
+    fingerprint = models.CharField(max_length=64)
+    response_status = models.PositiveSmallIntegerField(null=True)
+    response_body = models.JSONField(null=True, encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "key"], name="idempotency_key_user_key_unique")
+        ]
+
+    def __str__(self):
+        return f"{self.user} {self.key}"
+
+
+class OutboxMessage(models.Model):
+    """
+    Celery task written in the transaction of the changes it is about and published
+    by the relay (relay_outbox command) once committed.
+    """
+
+    task = models.CharField(max_length=255)
+    kwargs = models.JSONField(encoder=DjangoJSONEncoder)
+    eta = models.DateTimeField(null=True, blank=True)
+    # the same message is enqueued once
+    dedupe_key = models.CharField(max_length=255, unique=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    published_at = models.DateTimeField(null=True, blank=True)
+    # set by the task, which skips messages published more than once
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["id"],
+                condition=models.Q(published_at__isnull=True),
+                name="outbox_unpublished_idx",
+            ),
+        ]
+
+    def __str__(self):
+        return self.dedupe_key
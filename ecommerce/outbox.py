@@ -0,0 +1,100 @@
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from buylando.celery import app
+from ecommerce.models import OutboxMessage
+
+
+def enqueue(task, kwargs, dedupe_key, eta=None):
+    """
+    Stores the task to be published after the current transaction commits.
+    Messages with an already enqueued dedupe_key are ignored.
+    """
+    enqueue_many(task, [(kwargs, dedupe_key)], eta=eta)
+
+
+def enqueue_many(task, messages, eta=None):
+    """
+    Stores many (kwargs, dedupe_key) messages of the task with a single insert.
+    """
+    OutboxMessage.objects.bulk_create(
+        [
+            OutboxMessage(task=task.name, kwargs=kwargs, eta=eta, dedupe_key=dedupe_key)
+            for kwargs, dedupe_key in messages
+        ],
+        ignore_conflicts=True,
+    )
+
+
+def relay(batch_size=None):
+    """
+    Publishes a batch of unpublished messages over a single broker connection
+    and returns their number. Rows are locked with SKIP LOCKED, so relays can run
+    in parallel.
+
+    Delivery is at least once: if the transaction fails after publishing, the batch
+    is published again. Tasks drop the duplicates with processing().
+    """
+    batch_size = batch_size or settings.OUTBOX_BATCH_SIZE
+
+    with transaction.atomic():
+        messages = list(
+            OutboxMessage.objects.filter(published_at__isnull=True)
+            .order_by("pk")
+            .select_for_update(skip_locked=True)[:batch_size]
+        )
+        if not messages:
+            return 0
+
+        # messages of tasks with a batch variant are published in batches of it
+        batches = defaultdict(list)
+        with app.producer_or_acquire() as producer:
+            for message in messages:
+                kwargs = message.kwargs | {"outbox_id": message.pk}
+                batch_task = settings.OUTBOX_BATCH_TASKS.get(message.task)
+                if batch_task is not None and message.eta is None:
+                    batches[batch_task].append(kwargs)
+                    continue
+
+                app.send_task(message.task, kwargs=kwargs, eta=message.eta, producer=producer)
+
+            for batch_task, payloads in batches.items():
+                for start in range(0, len(payloads), settings.OUTBOX_TASK_BATCH_SIZE):
+                    batch = payloads[start : start + settings.OUTBOX_TASK_BATCH_SIZE]
+                    app.send_task(batch_task, kwargs={"messages": batch}, producer=producer)
+
+        OutboxMessage.objects.filter(pk__in=[message.pk for message in messages]).update(
+            published_at=timezone.now()
+        )
+
+    return len(messages)
+
+
+@contextmanager
+def processing(messages):
+    """
+    Yields the task messages to process, without their outbox_id. Messages published
+    by the relay are left out if they were processed already or are being processed
+    by another worker.
+
+    Their rows stay locked until the block exits and are marked processed only if it
+    exits without an error, so a message that failed is processed again by its retry.
+    """
+    outbox_ids = [message["outbox_id"] for message in messages if message.get("outbox_id")]
+
+    with transaction.atomic():
+        claimed = set(
+            OutboxMessage.objects.filter(pk__in=outbox_ids, processed_at__isnull=True)
+            .select_for_update(skip_locked=True)
+            .values_list("pk", flat=True)
+        )
+        yield [
+            {key: value for key, value in message.items() if key != "outbox_id"}
+            for message in messages
+            if not message.get("outbox_id") or message["outbox_id"] in claimed
+        ]
+        OutboxMessage.objects.filter(pk__in=claimed).update(processed_at=timezone.now())
@@ -0,0 +1,20 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .cache import bump_catalogue_version
+from .models import Product, ProductCategory
+
+
+@receiver([post_save, post_delete], sender=Product)
+@receiver([post_save, post_delete], sender=ProductCategory)
+def invalidate_catalogue_cache(sender, **kwargs):
+    transaction.on_commit(bump_catalogue_version)
+
+
+@receiver(post_save, sender=ProductCategory)
+def touch_category_products(sender, instance, created, **kwargs):
+    # the category is embedded in the products' representation
+    if not created:
+        Product.objects.filter(category=instance).update(updated_at=timezone.now())
@@ -0,0 +1,43 @@
+import hashlib
+import os
+import posixpath
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    Stores files under the SHA-256 of their content, keeping the directory and extension
+    of the given name: full/photo.png -> full/3f/3f8a...c1.png
+
+    Identical files are stored once and a name never points to a different content,
+    so the files can be cached by clients indefinitely. Files are never overwritten,
+    unreferenced ones are removed by the collect_media_garbage command.
+    """
+
+    hash_chunk_size = 64 * 2**10
+
+    def get_content_name(self, name, content):
+        digest = hashlib.sha256()
+        for chunk in content.chunks(self.hash_chunk_size):
+            digest.update(chunk)
+        content.seek(0)
+
+        digest = digest.hexdigest()
+        extension = os.path.splitext(name)[1].lower()
+        return posixpath.join(posixpath.dirname(name), digest[:2], digest + extension)
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, "chunks"):
+            content = File(content, name)
+
+        name = self.get_content_name(name, content)
+        if self.exists(name):
+            # the file may be an orphan about to be collected, reusing it restarts its grace period
+            os.utime(self.path(name))
+            return name
+
+        return super().save(name, content, max_length)
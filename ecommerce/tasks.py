@@ -1,22 +1,343 @@
+from datetime import timedelta
+from itertools import groupby
+from operator import itemgetter
+
+from celery.signals import worker_process_shutdown
+from celery.utils.log import get_task_logger
 from django.conf import settings
-from django.core.mail import send_mail
-from django.template.loader import render_to_string
+from django.db import transaction
+from django.utils import timezone
+from PIL import Image, UnidentifiedImageError
 
 from buylando.celery import app
+from ecommerce import delivery, emails, outbox
+from ecommerce.cache import bump_catalogue_version
+from ecommerce.models import (
+    IdempotencyKey,
+    ImageStatus,
+    Order,
+    OutboxMessage,
+    PaymentStatus,
+    Product,
+)
 
+logger = get_task_logger(__name__)
 
-@app.task
-def queue_email(temp_subject, temp_html, temp_str, context, recipients):
-    subject = render_to_string(temp_subject).replace("\n", "")
-    message_html = render_to_string(temp_html, context)
-    message_str = render_to_string(temp_str, context)
-
-    send_mail(
-        subject=subject,
-        message=message_str,
-        html_message=message_html,
-        from_email=settings.EMAIL_SENDER,
-        recipient_list=recipients,
-    )
+# files that can not be decoded, retrying them would not help
+CORRUPT_IMAGE_ERRORS = (UnidentifiedImageError, Image.DecompressionBombError, SyntaxError)
+
+
+def _render(payloads):
+    """
+    Renders queue_email payloads into (subject, text, html) tuples with the compiled
+    templates, consecutive payloads of the same templates in a single batch.
+    """
+    rendered = []
+    templates = itemgetter("temp_subject", "temp_str", "temp_html")
+    for (temp_subject, temp_str, temp_html), group in groupby(payloads, templates):
+        contexts = [payload["context"] for payload in group]
+        subject = emails.render_subject(temp_subject)
+        texts = emails.render_many(temp_str, contexts)
+        htmls = emails.render_many(temp_html, contexts)
+        rendered += [(subject, text, html) for text, html in zip(texts, htmls)]
+    return rendered
+
+
+def _send(payloads):
+    """
+    Renders and sends queue_email payloads over the pooled connection.
+    Yields each payload with the recipients it failed for.
+    """
+    for payload, (subject, text, html) in zip(payloads, _render(payloads)):
+        messages = delivery.build_messages(subject, text, html, payload["recipients"])
+        failed = delivery.send_messages(messages)
+        yield payload, [recipient for message in failed for recipient in message.to]
+
+
+def _deliver(payloads):
+    """
+    Sends queue_email payloads, returns them narrowed to their failed recipients.
+    """
+    return [
+        payload | {"recipients": recipients}
+        for payload, recipients in _send(payloads)
+        if recipients
+    ]
+
+
+def _get_retry_countdown(task):
+    return settings.EMAIL_RETRY_BACKOFF * 2**task.request.retries
+
+
+# a message is acknowledged once its task has run, so the emails of a worker that
+# crashed are sent by another one, and marked processed in the outbox once sent
+EMAIL_TASK_OPTIONS = {
+    "bind": True,
+    "acks_late": True,
+    "reject_on_worker_lost": True,
+    "max_retries": settings.EMAIL_MAX_RETRIES,
+}
+
+
+@app.task(
+    **EMAIL_TASK_OPTIONS,
+    autoretry_for=(Exception,),
+    retry_backoff=settings.EMAIL_RETRY_BACKOFF,
+    retry_jitter=False,
+)
+def queue_email(self, temp_subject, temp_html, temp_str, context, recipients, outbox_id=None):
+    # nothing queues it anymore, it is kept to send the messages (some with an ETA)
+    # still in the broker from before send_order_email, it can be removed once drained
+    payload = {
+        "temp_subject": temp_subject,
+        "temp_html": temp_html,
+        "temp_str": temp_str,
+        "context": context,
+        "recipients": recipients,
+        "outbox_id": outbox_id,
+    }
+    # published by the outbox relay, possibly more than once
+    with outbox.processing([payload]) as payloads:
+        if not payloads:
+            return "Email already sent."
+        failed = _deliver(payloads)
+
+    if failed:
+        # only the failed recipients are retried, the message is marked processed
+        raise self.retry(kwargs=failed[0], countdown=_get_retry_countdown(self))
 
     return "Email sent."
+
+
+def _deliver_order_emails(messages):
+    """
+    Sends {"order_id", "template"} messages, loading all their orders at once.
+    Returns the messages that failed.
+    """
+    orders = emails.get_orders({message["order_id"] for message in messages}).in_bulk()
+
+    pending, payloads = [], []
+    for message in messages:
+        order = orders.get(message["order_id"])
+        payload = order and emails.get_order_email(message["template"], order)
+        if payload is not None:  # not deleted or paid in the meantime
+            pending.append(message)
+            payloads.append(payload)
+
+    return [message for message, (_, failed) in zip(pending, _send(payloads)) if failed]
+
+
+@app.task(
+    **EMAIL_TASK_OPTIONS,
+    autoretry_for=(Exception,),
+    retry_backoff=settings.EMAIL_RETRY_BACKOFF,
+    retry_jitter=False,
+)
+def send_order_email(self, order_id, template, outbox_id=None):
+    """
+    Sends an email about the order, rendered from its current state.
+    Unexpected errors are retried like refused recipients.
+    """
+    message = {"order_id": order_id, "template": template, "outbox_id": outbox_id}
+    with outbox.processing([message]) as pending:
+        if not pending:
+            return "Email already sent."
+        failed = _deliver_order_emails(pending)
+
+    if failed:
+        raise self.retry(kwargs=failed[0], countdown=_get_retry_countdown(self))
+
+    return "Email sent."
+
+
+@app.task(**EMAIL_TASK_OPTIONS)
+def send_order_emails(self, messages):
+    """
+    Batch variant of send_order_email, used by the outbox relay.
+    A batch that fails unexpectedly is split into send_order_email tasks,
+    so that one bad order does not hold back the emails of the others.
+    """
+    try:
+        with outbox.processing(messages) as pending:
+            failed = _deliver_order_emails(pending)
+    except Exception:
+        logger.exception("Sending %d emails failed, retrying them one by one.", len(messages))
+        for message in messages:
+            send_order_email.apply_async(kwargs=message, countdown=_get_retry_countdown(self))
+        return f"{len(messages)} emails split into separate tasks."
+
+    if failed:
+        logger.warning("%d of %d emails failed, retrying.", len(failed), len(pending))
+        raise self.retry(kwargs={"messages": failed}, countdown=_get_retry_countdown(self))
+
+    return f"{len(pending)} emails sent."
+
+
+@worker_process_shutdown.connect
+def close_mail_connection(**kwargs):
+    delivery.close_connection()
+
+
+def _create_renditions(product):
+    """
+    Creates the product's renditions and returns its miniature status.
+    Corrupt files fail right away, other errors are raised to be retried.
+    """
+    try:
+        product.create_renditions()
+        return ImageStatus.READY
+    except CORRUPT_IMAGE_ERRORS:
+        logger.exception("The image of product %s is corrupt.", product.pk)
+        product.image_min, product.renditions = "", {}
+        return ImageStatus.FAILED
+
+
+@app.task(bind=True, max_retries=3)
+def create_image_min(self, product_id):
+    """
+    Creates the miniature and the renditions of a saved product.
+    Corrupt files are marked as failed right away, other errors (ex. the storage
+    being unavailable) are retried with an exponential backoff first.
+    """
+    product = Product.objects.filter(pk=product_id).only("image").first()
+    if product is None:
+        return "Product does not exist."
+
+    try:
+        status = _create_renditions(product)
+    except OSError as exc:
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=exc, countdown=2**self.request.retries * 10)
+        logger.exception("Could not create the miniature of product %s.", product_id)
+        product.image_min, product.renditions, status = "", {}, ImageStatus.FAILED
+
+    # the image might have been replaced in the meantime, its own task takes over then
+    updated = Product.objects.filter(pk=product_id, image=product.image.name).update(
+        image_min=product.image_min.name,
+        renditions=product.renditions,
+        image_min_status=status,
+        updated_at=timezone.now(),
+    )
+    if updated:
+        bump_catalogue_version()
+
+    return f"Miniature {status}."
+
+
+def save_renditions(products):
+    """
+    Saves the renditions of the products with a single bulk update. Products whose
+    image has been replaced in the meantime are skipped, their own task takes over.
+    Returns the saved products.
+    """
+    with transaction.atomic():
+        images = dict(
+            Product.objects.filter(pk__in=[product.pk for product in products])
+            .select_for_update()
+            .values_list("pk", "image")
+        )
+        products = [
+            product for product in products if images.get(product.pk) == product.image.name
+        ]
+        Product.objects.bulk_update(
+            products, ["image_min", "renditions", "image_min_status", "updated_at"]
+        )
+    return products
+
+
+def queue_images_min(product_ids):
+    """
+    Queues the miniatures of products inserted in bulk, in tasks of
+    PRODUCT_IMAGE_TASK_BATCH_SIZE products that the image workers run in parallel.
+    """
+    batch_size = settings.PRODUCT_IMAGE_TASK_BATCH_SIZE
+    for start in range(0, len(product_ids), batch_size):
+        create_images_min.delay(product_ids[start : start + batch_size])
+
+
+@app.task
+def create_images_min(product_ids):
+    """
+    Creates miniatures of products inserted in bulk (bypassing Product.save()).
+    Images failing with other errors than corrupt files are handed over
+    to create_image_min, which retries them.
+    """
+    products, retried = [], []
+    for product in Product.objects.filter(pk__in=product_ids).only("image"):
+        try:
+            product.image_min_status = _create_renditions(product)
+        except OSError:
+            retried.append(product.pk)
+            continue
+
+        product.updated_at = timezone.now()
+        products.append(product)
+
+    products = save_renditions(products)
+    if products:
+        bump_catalogue_version()
+    for product_id in retried:
+        create_image_min.delay(product_id)
+
+    ready = sum(product.image_min_status == ImageStatus.READY for product in products)
+    return f"{ready} miniatures created, {len(retried)} retried."
+
+
+@app.task
+def purge_idempotency_keys():
+    expired = timezone.now() - timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL)
+    deleted, _ = IdempotencyKey.objects.filter(created_at__lt=expired).delete()
+    return f"{deleted} idempotency keys purged."
+
+
+@app.task
+def purge_outbox():
+    expired = timezone.now() - timedelta(seconds=settings.OUTBOX_RETENTION)
+    deleted, _ = OutboxMessage.objects.filter(
+        published_at__lt=expired, processed_at__isnull=False
+    ).delete()
+    return f"{deleted} outbox messages purged."
+
+
+@app.task
+def send_payment_reminders():
+    """
+    Sends reminders of the unpaid orders whose payment deadline passed
+    PAYMENT_REMINDER_DELAY ago, in batches found with the order_reminder_due_idx index.
+    Each order is marked in the transaction writing its reminder to the outbox,
+    so it is reminded once. Paid orders are never picked up.
+    """
+    due = timezone.now() - timedelta(seconds=settings.PAYMENT_REMINDER_DELAY)
+    sent = 0
+
+    while True:
+        with transaction.atomic():
+            orders = list(
+                Order.objects.only("pk")
+                .filter(
+                    payment_status=PaymentStatus.UNPAID,
+                    reminder_sent_at__isnull=True,
+                    payment_deadline__lte=due,
+                )
+                .order_by("payment_deadline")
+                .select_for_update(skip_locked=True)[: settings.PAYMENT_REMINDER_BATCH_SIZE]
+            )
+            if not orders:
+                break
+
+            Order.objects.filter(pk__in=[order.pk for order in orders]).update(
+                reminder_sent_at=timezone.now()
+            )
+            outbox.enqueue_many(
+                send_order_email,
+                [
+                    (
+                        {"order_id": order.pk, "template": "payment_reminder"},
+                        f"payment-reminder:{order.pk}",
+                    )
+                    for order in orders
+                ],
+            )
+        sent += len(orders)
+
+    return f"{sent} payment reminders sent."
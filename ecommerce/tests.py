@@ -1 +1,1555 @@
-# Create your tests here.
+import base64
+import codecs
+import csv
+import gzip
+import io
+import json
+import smtplib
+import tempfile
+import time
+import tracemalloc
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock, skipUnless
+
+from django.conf import settings
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db import DatabaseError, connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import (
+    RequestFactory,
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image, UnidentifiedImageError
+from rest_framework.test import APIClient
+
+from core.models import Role, User
+from ecommerce import delivery, outbox, tasks
+from ecommerce.api.filters import get_product_facets
+from ecommerce.api.serializers import ProductBulkUpdateSerializer, ReadonlyProductSerializer
+from ecommerce.cache import get_catalogue_state, get_or_build
+from ecommerce.exporters import CSV_COLUMNS
+from ecommerce.importers import ProductImport
+from ecommerce.models import (
+    IdempotencyKey,
+    ImageStatus,
+    Order,
+    OrderItem,
+    OutboxMessage,
+    PaymentStatus,
+    Product,
+    ProductCategory,
+    ShippingAddress,
+    UploadSession,
+    UploadStatus,
+)
+
+
+def get_product_queries(queries, pattern):
+    return [
+        query["sql"]
+        for query in queries
+        if pattern in query["sql"] and '"ecommerce_product"' in query["sql"]
+    ]
+
+
+def create_products(n, **fields):
+    category = ProductCategory.objects.create(name="Computers")
+    # bulk_create skips Product.save(), which queues the miniature tasks
+    return Product.objects.bulk_create(
+        Product(
+            name=f"Product {i}",
+            description=f"Description of product {i}",
+            price=100 + i % 50,
+            category=category,
+            image=f"full/product{i}.png",
+            **fields,
+        )
+        for i in range(n)
+    )
+
+
+def create_order(user, products=(), **fields):
+    address = ShippingAddress.objects.create(
+        user=user,
+        full_name="John Doe",
+        street="Main Street 1",
+        zip_code="00-001",
+        city="Warsaw",
+        country="PL",
+    )
+    order = Order.objects.create(user=user, shipping_address=address, **fields)
+    OrderItem.objects.bulk_create(
+        OrderItem(order=order, product=product, quantity=1, unit_price=product.price)
+        for product in products
+    )
+    return order
+
+
+class ProductSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = ProductCategory.objects.create(name="Computers")
+        cls.laptop, cls.bag, cls.mouse = Product.objects.bulk_create(
+            Product(name=name, description=description, price=100, category=category)
+            for name, description in [
+                ("Gaming laptop", "Fast and light."),
+                ("Backpack", "Fits any 15 inch laptops and tablets."),
+                ("Wireless mouse", None),
+            ]
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    def search(self, **params):
+        response = self.client.get(reverse("products"), params)
+        self.assertEqual(response.status_code, 200)
+        return [product["id"] for product in response.data["results"]]
+
+    def test_q_ranks_names_above_descriptions(self):
+        # "laptops" is stemmed to the same lexeme as "laptop"
+        self.assertEqual(self.search(q="laptop"), [self.laptop.pk, self.bag.pk])
+        self.assertEqual(self.search(q="laptops"), [self.laptop.pk, self.bag.pk])
+
+    def test_q_matches_substrings(self):
+        self.assertEqual(self.search(q="wirel"), [self.mouse.pk])
+
+    def test_q_is_combined_with_other_filters(self):
+        self.assertEqual(self.search(q="laptop", desc="tablet"), [self.bag.pk])
+
+    def test_name_and_desc_filters(self):
+        self.assertEqual(self.search(name="LAPTOP"), [self.laptop.pk])
+        self.assertEqual(self.search(desc="inch lap"), [self.bag.pk])
+
+    def test_search_vector_follows_updates(self):
+        Product.objects.filter(pk=self.mouse.pk).update(description="Works with any laptop.")
+
+        self.assertEqual(self.search(q="laptop"), [self.laptop.pk, self.bag.pk, self.mouse.pk])
+
+
+class ProductFacetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        computers = ProductCategory.objects.create(name="Computers")
+        laptops = ProductCategory.objects.create(name="Laptops")
+        cls.products = Product.objects.bulk_create(
+            Product(name=f"Product {i}", price=price, category=category)
+            for i, (category, price) in enumerate(
+                [
+                    (computers, "50"),
+                    (computers, "99.99"),
+                    (computers, "100"),
+                    (computers, "600"),
+                    (laptops, "100"),
+                    (laptops, "2500"),
+                    (laptops, "6000"),
+                ]
+            )
+        )
+        cls.computers, cls.laptops = computers, laptops
+
+    def setUp(self):
+        cache.clear()
+
+    def get(self, **params):
+        response = self.client.get(reverse("products"), params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def get_ids(self, **params):
+        return [product["id"] for product in self.get(**params)["results"]]
+
+    def test_range_filters(self):
+        ids = [product.pk for product in self.products]
+
+        self.assertEqual(self.get_ids(price_min="100"), ids[2:])
+        self.assertEqual(self.get_ids(price_max="100"), ids[:3] + ids[4:5])
+        self.assertEqual(self.get_ids(price_min="99.99", price_max="600"), ids[1:5])
+        self.assertEqual(self.get_ids(price="100"), [ids[2], ids[4]])
+        self.assertEqual(self.get_ids(price_min="100", category="laptops"), ids[4:])
+
+    def test_inverted_range_is_refused(self):
+        response = self.client.get(reverse("products"), {"price_min": "200", "price_max": "100"})
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_facets_count_the_filtered_products(self):
+        facets = self.get(facets="1")["facets"]
+
+        self.assertEqual(
+            facets["categories"],
+            [
+                {"id": self.computers.pk, "name": "Computers", "count": 4},
+                {"id": self.laptops.pk, "name": "Laptops", "count": 3},
+            ],
+        )
+        self.assertEqual(
+            facets["prices"],
+            [
+                {"min": 0, "max": 100, "count": 2},
+                {"min": 100, "max": 500, "count": 2},
+                {"min": 500, "max": 1000, "count": 1},
+                {"min": 1000, "max": 2500, "count": 0},
+                {"min": 2500, "max": 5000, "count": 1},
+                {"min": 5000, "max": None, "count": 1},
+            ],
+        )
+
+        facets = self.get(facets="1", price_min="100", price_max="2500")["facets"]
+
+        self.assertEqual([category["count"] for category in facets["categories"]], [2, 2])
+        self.assertEqual([price["count"] for price in facets["prices"]], [0, 2, 1, 0, 1, 0])
+
+    def test_facets_are_only_added_on_request(self):
+        self.assertNotIn("facets", self.get())
+        self.assertIn("facets", self.get(facets="true", pagination="cursor"))
+
+    def test_facets_are_cached_per_filters(self):
+        with mock.patch(
+            "ecommerce.api.views.get_product_facets", wraps=get_product_facets
+        ) as build:
+            first = self.get(facets="1", price_max="100")["facets"]
+            # another page or ordering of the same filtered products
+            self.get(facets="1", price_max="100", page="1", order="name")
+            self.assertEqual(build.call_count, 1)
+
+            other = self.get(facets="1", price_max="600")["facets"]
+            self.assertEqual(build.call_count, 2)
+
+        self.assertNotEqual(first, other)
+
+    def test_facets_are_rebuilt_after_a_catalogue_change(self):
+        self.get(facets="1")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.products[-1].delete()
+
+        facets = self.get(facets="1")["facets"]
+        self.assertEqual([category["count"] for category in facets["categories"]], [4, 2])
+        self.assertEqual(facets["prices"][-1]["count"], 0)
+
+
+class ProductCursorPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.products = create_products(25)
+        laptops = ProductCategory.objects.create(name="Laptops")
+        Product.objects.filter(pk__in=[product.pk for product in cls.products[::3]]).update(
+            category=laptops
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    def get_page(self, url, params=None):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def walk(self, params):
+        """
+        Returns the ids of the pages following the next links, then the previous ones.
+        """
+        forward, backward = [], []
+        page = self.get_page(reverse("products"), params | {"pagination": "cursor"})
+        forward.append([product["id"] for product in page["results"]])
+        while page["next"]:
+            page = self.get_page(page["next"])
+            forward.append([product["id"] for product in page["results"]])
+
+        backward.append(forward[-1])
+        while page["previous"]:
+            page = self.get_page(page["previous"])
+            backward.insert(0, [product["id"] for product in page["results"]])
+        return forward, backward
+
+    def test_pages_follow_the_ordering(self):
+        for order in [None, "name", "category", "price", "-price"]:
+            with self.subTest(order=order):
+                params = {"order": order} if order else {}
+                expected = list(
+                    Product.objects.order_by(order or "pk", "pk").values_list("pk", flat=True)
+                )
+
+                forward, backward = self.walk(params)
+
+                self.assertEqual([len(page) for page in forward], [10, 10, 5])
+                self.assertEqual(sum(forward, []), expected)
+                self.assertEqual(backward, forward)
+
+    def test_count_estimate(self):
+        page = self.get_page(reverse("products"), {"pagination": "cursor", "count": "estimate"})
+
+        self.assertIsInstance(page["count"], int)
+        self.assertIsInstance(self.get_page(page["next"])["count"], int)
+        self.assertNotIn("count", self.get_page(reverse("products"), {"pagination": "cursor"}))
+
+    def test_invalid_cursor(self):
+        def encode(cursor):
+            return base64.urlsafe_b64encode(json.dumps(cursor).encode("utf-8")).decode("ascii")
+
+        for cursor in [
+            "not base64",
+            encode({"v": ["x", 1], "r": False}),
+            encode({"v": [None, 1], "r": False}),
+            encode({"v": ["100.00"], "r": False}),
+            encode({"v": ["100.00", 1], "r": "no"}),
+            encode({"v": {"price": "100.00"}, "r": False}),
+        ]:
+            with self.subTest(cursor=cursor):
+                response = self.client.get(
+                    reverse("products"),
+                    {"pagination": "cursor", "order": "price", "cursor": cursor},
+                )
+                self.assertEqual(response.status_code, 404)
+
+
+class ProductValuesSerializerTests(TestCase):
+    params = [
+        {},
+        {"order": "price"},
+        {"pagination": "cursor", "order": "name"},
+        {"fields": "id,name,price"},
+        {"fields": "id,category,image,image_min,srcset"},
+        {"fields": "category,updated_at", "expand": "category"},
+        {"fields": "description,image_min_status", "order": "category"},
+    ]
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.products = create_products(
+            12,
+            image_min="mini/product.webp",
+            image_min_status=ImageStatus.READY,
+            renditions={"webp": [[320, "renditions/a b.webp"], [640, "renditions/c.webp"]]},
+        )
+        Product.objects.filter(pk=cls.products[0].pk).update(
+            description=None, image_min="", renditions={}
+        )
+
+    def get_with_both_serializers(self, view, url, params):
+        """
+        Returns the responses of the view's values serializer and of ReadonlyProductSerializer.
+        """
+        cache.clear()
+        responses = [self.client.get(url, params)]
+        cache.clear()
+        with mock.patch(
+            f"ecommerce.api.views.{view}.read_serializer_class", ReadonlyProductSerializer
+        ):
+            responses.append(self.client.get(url, params))
+        return responses
+
+    def test_list_output_is_identical(self):
+        for params in self.params:
+            with self.subTest(**params):
+                values, serialized = self.get_with_both_serializers(
+                    "ProductListView", reverse("products"), params
+                )
+                self.assertEqual(values.status_code, 200)
+                self.assertEqual(values.content, serialized.content)
+
+    def test_detail_output_is_identical(self):
+        for product in self.products[:2]:
+            for params in self.params:
+                with self.subTest(product=product.pk, **params):
+                    values, serialized = self.get_with_both_serializers(
+                        "ProductDetailView", reverse("product", args=[product.pk]), params
+                    )
+                    self.assertEqual(values.status_code, 200)
+                    self.assertEqual(values.content, serialized.content)
+
+
+# several chunks per response
+@override_settings(PRODUCT_EXPORT_CHUNK_SIZE=7)
+class ProductExportTests(TestCase):
+    params = {"price_min": "110", "price_max": "139"}
+
+    @classmethod
+    def setUpTestData(cls):
+        create_products(120)
+
+    def export(self, output, compress=False):
+        params = self.params | {"output": output, "gzip": "true" if compress else ""}
+        response = self.client.get(reverse("products-export"), params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+
+        content = b"".join(response.streaming_content)
+        if compress:
+            self.assertEqual(response["Content-Encoding"], "gzip")
+            content = gzip.decompress(content)
+        return content.decode("utf-8")
+
+    def get_expected(self):
+        request = RequestFactory().get(reverse("products-export"))
+        products = Product.objects.filter(price__gte=110, price__lte=139).order_by("pk")
+        return json.loads(
+            json.dumps(
+                ReadonlyProductSerializer(products, many=True, context={"request": request}).data
+            )
+        )
+
+    def test_ndjson(self):
+        expected = self.get_expected()
+        self.assertEqual(len(expected), 70)
+
+        for compress in (False, True):
+            with self.subTest(compress=compress):
+                lines = self.export("ndjson", compress).splitlines()
+                self.assertEqual([json.loads(line) for line in lines], expected)
+
+    def test_csv(self):
+        expected = []
+        for product in self.get_expected():
+            product["category"] = product["category"]["name"]
+            # csv writes None as an empty string
+            expected.append(
+                ["" if product[name] is None else str(product[name]) for name in CSV_COLUMNS]
+            )
+
+        for compress in (False, True):
+            with self.subTest(compress=compress):
+                rows = list(csv.reader(io.StringIO(self.export("csv", compress))))
+                self.assertEqual(rows[0], list(CSV_COLUMNS))
+                self.assertEqual(rows[1:], expected)
+
+    @override_settings(PRODUCT_EXPORT_CHUNK_SIZE=100)
+    def test_memory_does_not_grow_with_the_export(self):
+        create_products(5000)
+        url = reverse("products-export")
+        # imports and caches filled by the first request are not measured
+        self.export("ndjson")
+
+        size = 0
+        tracemalloc.start()
+        try:
+            baseline = tracemalloc.get_traced_memory()[0]
+            response = self.client.get(url, {"output": "ndjson"})
+            for piece in response.streaming_content:
+                size += len(piece)
+            peak = tracemalloc.get_traced_memory()[1] - baseline
+        finally:
+            tracemalloc.stop()
+
+        # rows are fetched and written 100 at a time, holding the export whole
+        # (or all its rows) would take more than its size
+        self.assertGreater(size, 1_000_000)
+        self.assertLess(peak, size / 2)
+
+
+class ProductImportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        ProductCategory.objects.create(name="Computers")
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root.name))
+
+        self.archive = io.BytesIO()
+        with zipfile.ZipFile(self.archive, "w") as archive:
+            archive.writestr("laptop.png", b"image")
+        self.archive.seek(0)
+
+    def run_import(self, content, format, chunk_size=2):
+        with mock.patch("ecommerce.importers.bump_catalogue_version") as bump, mock.patch(
+            "ecommerce.tasks.queue_images_min"
+        ) as queue_images_min, self.captureOnCommitCallbacks(execute=True):
+            report = ProductImport(archive=self.archive, chunk_size=chunk_size).run(
+                io.BytesIO(content), format
+            )
+        return report, bump, queue_images_min
+
+    def test_csv(self):
+        content = (
+            codecs.BOM_UTF8
+            + b"name,description,price,category,image\n"
+            + b"Laptop,,999.99,computers,laptop.png\n"
+            + b"Bad price,,free,Computers,laptop.png\n"
+            + b'"Bad \xff name",,10,Computers,laptop.png\n'
+            + b'Tablet,"Two\nlines",499,Computers,laptop.png\n'
+            + b"Mouse,,10,Computers,missing.png\n"
+        )
+
+        report, bump, queue_images_min = self.run_import(content, "csv")
+
+        self.assertEqual(report["created"], 2)
+        self.assertEqual(
+            report["errors"],
+            [
+                {"line": 3, "errors": {"price": ["A valid number is required."]}},
+                {"line": 4, "errors": ["Invalid row."]},
+                {"line": 7, "errors": {"image": ["Image not found."]}},
+            ],
+        )
+        self.assertEqual(Product.objects.get(name="Tablet").description, "Two\nlines")
+        # a version bump and miniatures per chunk, the last one has no valid rows
+        self.assertEqual(bump.call_count, 2)
+        self.assertEqual(queue_images_min.call_count, 2)
+
+    def test_jsonl(self):
+        content = (
+            b'{"name": "Laptop", "price": "999.99", "category": "Computers", "image": "laptop.png"}\n'
+            + b"\n"
+            + b'{"name": "Bad \xff name"}\n'
+            + b"not json\n"
+        )
+
+        report, bump, queue_images_min = self.run_import(content, "jsonl")
+
+        self.assertEqual(report["created"], 1)
+        self.assertEqual(
+            report["errors"],
+            [{"line": 3, "errors": ["Invalid row."]}, {"line": 4, "errors": ["Invalid row."]}],
+        )
+        queue_images_min.assert_called_once_with([Product.objects.get().pk])
+
+    def test_command(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path, archive_path = f"{directory.name}/products.csv", f"{directory.name}/images.zip"
+        with open(path, "wb") as file:
+            file.write(b"name,price,category,image\nLaptop,999,Computers,laptop.png\nMouse\n")
+        with open(archive_path, "wb") as file:
+            file.write(self.archive.getvalue())
+
+        output = io.StringIO()
+        with mock.patch("ecommerce.tasks.queue_images_min"):
+            call_command("import_products", path, archive=archive_path, stdout=output)
+
+        self.assertIn("Line 3:", output.getvalue())
+        self.assertIn("1 products imported, 1 rows skipped", output.getvalue())
+        self.assertTrue(Product.objects.filter(name="Laptop").exists())
+
+
+class ProductImageTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = ProductCategory.objects.create(name="Computers")
+
+    def create_product(self):
+        with mock.patch.object(tasks.create_image_min, "delay") as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                product = Product.objects.create(
+                    name="Laptop", price=999, category=self.category, image="full/laptop.png"
+                )
+        delay.assert_called_once_with(product.pk)
+        return product
+
+    def save(self, product, **kwargs):
+        """
+        Saves the product, returns whether its miniature task was queued.
+        """
+        with mock.patch.object(tasks.create_image_min, "delay") as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                product.save(**kwargs)
+        return delay.called
+
+    def test_only_a_new_image_queues_the_miniature(self):
+        product = self.create_product()
+        self.assertEqual(product.image_min_status, ImageStatus.PENDING)
+        Product.objects.filter(pk=product.pk).update(image_min_status=ImageStatus.READY)
+
+        product = Product.objects.get(pk=product.pk)
+        product.name = "Renamed"
+        self.assertFalse(self.save(product))
+
+        for deferred in [Product.objects.only("name"), Product.objects.defer("image")]:
+            with self.subTest(deferred=deferred.query.deferred_loading):
+                product = deferred.get(pk=product.pk)
+                product.name = "Renamed again"
+                with self.assertNumQueries(1):
+                    self.assertFalse(self.save(product))
+
+        product = Product.objects.only("name").get(pk=product.pk)
+        product.image = "full/new.png"
+        self.assertTrue(self.save(product))
+        product.refresh_from_db()
+        self.assertEqual(product.image_min_status, ImageStatus.PENDING)
+
+    def run_task(self, product, create_renditions):
+        with mock.patch(
+            "ecommerce.models.images.create_renditions", side_effect=create_renditions
+        ) as create, mock.patch("ecommerce.tasks.bump_catalogue_version") as bump:
+            result = tasks.create_image_min.apply(args=[product.pk])
+        product.refresh_from_db()
+        return result.get(), create.call_count, bump.called
+
+    def test_pending_to_ready(self):
+        product = self.create_product()
+        renditions = {"webp": [[320, "renditions/laptop-320w.webp"]]}
+
+        result = self.run_task(product, [("mini/laptop.webp", renditions)])
+
+        self.assertEqual(result, ("Miniature ready.", 1, True))
+        self.assertEqual(product.image_min_status, ImageStatus.READY)
+        self.assertEqual(
+            (product.image_min.name, product.renditions), ("mini/laptop.webp", renditions)
+        )
+
+    def test_corrupt_image_fails_without_retries(self):
+        product = self.create_product()
+
+        result = self.run_task(product, UnidentifiedImageError)
+
+        self.assertEqual(result, ("Miniature failed.", 1, True))
+        self.assertEqual(product.image_min_status, ImageStatus.FAILED)
+
+    def test_unavailable_storage_is_retried(self):
+        product = self.create_product()
+
+        result = self.run_task(product, [OSError, OSError, ("mini/laptop.webp", {})])
+
+        self.assertEqual(result, ("Miniature ready.", 3, True))
+        self.assertEqual(product.image_min_status, ImageStatus.READY)
+
+    def test_fails_once_the_retries_are_exhausted(self):
+        product = self.create_product()
+
+        result = self.run_task(product, OSError)
+
+        self.assertEqual(result, ("Miniature failed.", 4, True))
+        self.assertEqual(product.image_min_status, ImageStatus.FAILED)
+
+    def test_replaced_image_is_left_to_its_own_task(self):
+        product = self.create_product()
+
+        def replace_image(*args):
+            Product.objects.filter(pk=product.pk).update(image="full/new.png")
+            return "mini/laptop.webp", {}
+
+        result = self.run_task(product, replace_image)
+
+        self.assertEqual(result, ("Miniature ready.", 1, False))
+        self.assertEqual(product.image_min_status, ImageStatus.PENDING)
+
+
+class ImagesMinTests(TestCase):
+    @override_settings(PRODUCT_IMAGE_TASK_BATCH_SIZE=2)
+    def test_queued_in_batches(self):
+        with mock.patch.object(tasks.create_images_min, "delay") as delay:
+            tasks.queue_images_min([1, 2, 3, 4, 5])
+
+        self.assertEqual(
+            delay.call_args_list, [mock.call([1, 2]), mock.call([3, 4]), mock.call([5])]
+        )
+
+    def test_transient_errors_are_handed_over_to_create_image_min(self):
+        ready, unavailable, replaced = create_products(3)
+
+        def create_renditions(product):
+            if product.pk == unavailable.pk:
+                raise OSError("Storage unavailable")
+            if product.pk == replaced.pk:
+                Product.objects.filter(pk=replaced.pk).update(image="full/new.png")
+            return ImageStatus.READY
+
+        with mock.patch(
+            "ecommerce.tasks._create_renditions", side_effect=create_renditions
+        ), mock.patch.object(tasks.create_image_min, "delay") as delay:
+            tasks.create_images_min([ready.pk, unavailable.pk, replaced.pk])
+
+        delay.assert_called_once_with(unavailable.pk)
+        statuses = dict(Product.objects.values_list("pk", "image_min_status"))
+        self.assertEqual(statuses[ready.pk], ImageStatus.READY)
+        self.assertEqual(statuses[unavailable.pk], ImageStatus.PENDING)
+        # the task of the new image takes over
+        self.assertEqual(statuses[replaced.pk], ImageStatus.PENDING)
+
+
+class UploadSessionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.seller = User.objects.create_user(email="seller@mail.com", role=Role.SELLER)
+        cls.category = ProductCategory.objects.create(name="Computers")
+
+        image = io.BytesIO()
+        Image.new("RGB", (40, 30), "red").save(image, "PNG")
+        cls.image = image.getvalue()
+
+    def setUp(self):
+        for name in ("MEDIA_ROOT", "PRODUCT_UPLOAD_TEMP_DIR"):
+            directory = tempfile.TemporaryDirectory()
+            self.addCleanup(directory.cleanup)
+            self.enterContext(override_settings(**{name: directory.name}))
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.seller)
+
+    def create_session(self):
+        response = self.client.post(
+            reverse("uploads"), {"filename": "laptop.png", "size": len(self.image)}
+        )
+        self.assertEqual(response.status_code, 201)
+        return response.data["id"]
+
+    def put_chunk(self, session_id, offset, chunk, **extra):
+        return self.client.generic(
+            "PUT",
+            reverse("upload", args=[session_id]),
+            chunk,
+            content_type="application/octet-stream",
+            HTTP_UPLOAD_OFFSET=str(offset),
+            **extra,
+        )
+
+    def finalize(self, session_id):
+        return self.client.post(reverse("upload-finalize", args=[session_id]))
+
+    def test_upload_is_resumed_and_attached_to_a_product(self):
+        session_id = self.create_session()
+
+        response = self.put_chunk(session_id, 0, self.image[:50])
+        self.assertEqual((response.status_code, response["Upload-Offset"]), (200, "50"))
+
+        # the client lost the response of the next chunk and asks where to resume
+        self.put_chunk(session_id, 50, self.image[50:60])
+        response = self.client.get(reverse("upload", args=[session_id]))
+        self.assertEqual(response.data["offset"], 60)
+
+        response = self.put_chunk(session_id, 60, self.image[60:])
+        self.assertEqual(response.data["offset"], len(self.image))
+
+        response = self.finalize(session_id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["status"], UploadStatus.COMPLETE)
+        with default_storage.open(response.data["image"]) as image:
+            self.assertEqual(image.read(), self.image)
+
+        with mock.patch.object(tasks.create_image_min, "delay"):
+            response = self.client.post(
+                reverse("products"),
+                {
+                    "name": "Laptop",
+                    "price": 999,
+                    "category": self.category.pk,
+                    "upload": session_id,
+                },
+                format="json",
+            )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(
+            Product.objects.get(name="Laptop").image.name, UploadSession.objects.get().image
+        )
+
+    def test_retried_chunk_overwrites_the_rest(self):
+        session_id = self.create_session()
+        self.put_chunk(session_id, 0, b"x" * 80)
+
+        response = self.put_chunk(session_id, 0, self.image)
+        self.assertEqual(response.data["offset"], len(self.image))
+
+        self.assertEqual(self.finalize(session_id).status_code, 200)
+
+    def test_offset_past_the_received_bytes_is_a_conflict(self):
+        session_id = self.create_session()
+        self.put_chunk(session_id, 0, self.image[:50])
+
+        response = self.put_chunk(session_id, 60, self.image[60:])
+
+        self.assertEqual((response.status_code, response["Upload-Offset"]), (409, "50"))
+
+    def test_completed_upload_is_a_conflict(self):
+        session_id = self.create_session()
+        self.put_chunk(session_id, 0, self.image)
+        self.finalize(session_id)
+
+        self.assertEqual(self.put_chunk(session_id, 0, self.image).status_code, 409)
+
+    def test_invalid_chunks(self):
+        session_id = self.create_session()
+
+        for offset, chunk, extra in [
+            (0, self.image + b"x", {}),
+            (-1, self.image[:10], {}),
+            (0, self.image[:10], {"CONTENT_LENGTH": "-1"}),
+        ]:
+            with self.subTest(offset=offset, extra=extra):
+                response = self.put_chunk(session_id, offset, chunk, **extra)
+                self.assertEqual(response.status_code, 400)
+
+        self.assertEqual(UploadSession.objects.get().offset, 0)
+
+    def test_incomplete_upload_is_not_finalized(self):
+        session_id = self.create_session()
+        self.put_chunk(session_id, 0, self.image[:50])
+
+        response = self.finalize(session_id)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(UploadSession.objects.get().status, UploadStatus.OPEN)
+
+
+class ProductBulkUpdateTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.seller = User.objects.create_user(email="seller@mail.com", role=Role.SELLER)
+        cls.products = create_products(10)
+        cls.category = ProductCategory.objects.create(name="Laptops")
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.seller)
+
+    def patch(self, data):
+        with mock.patch(
+            "ecommerce.api.serializers.bump_catalogue_version"
+        ) as bump, self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(reverse("products-bulk"), data, format="json")
+        return response, bump
+
+    def get_prices(self):
+        return dict(Product.objects.values_list("pk", "price"))
+
+    def test_changes(self):
+        first, second, third = self.products[:3]
+        changes = [
+            {"id": first.pk, "price": "9.99"},
+            {"id": second.pk, "category": self.category.pk},
+            {"id": third.pk, "price": "19.99", "category": self.category.pk},
+        ]
+
+        response, bump = self.patch({"changes": changes})
+
+        self.assertEqual(response.data, {"updated": 3})
+        bump.assert_called_once_with()
+        values = {
+            product.pk: (product.price, product.category_id)
+            for product in Product.objects.filter(pk__in=[first.pk, second.pk, third.pk])
+        }
+        self.assertEqual(
+            values,
+            {
+                first.pk: (Decimal("9.99"), first.category_id),
+                second.pk: (second.price, self.category.pk),
+                third.pk: (Decimal("19.99"), self.category.pk),
+            },
+        )
+
+    def test_changes_are_applied_in_batches(self):
+        changes = [{"id": product.pk, "price": "1.00"} for product in self.products]
+
+        with mock.patch.object(
+            ProductBulkUpdateSerializer, "CHANGES_BATCH_SIZE", 3
+        ), CaptureQueriesContext(connection) as queries:
+            response, _ = self.patch({"changes": changes})
+
+        self.assertEqual(response.data, {"updated": 10})
+        updates = [query for query in queries if query["sql"].lstrip().startswith("UPDATE")]
+        self.assertEqual(len(updates), 4)
+        self.assertEqual(set(self.get_prices().values()), {Decimal("1.00")})
+
+    def test_unknown_products_are_rejected(self):
+        changes = [{"id": self.products[0].pk, "price": "1.00"}, {"id": 0, "price": "1.00"}]
+
+        response, bump = self.patch({"changes": changes})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data["changes"], ["Products do not exist: [0]."])
+        bump.assert_not_called()
+        self.assertNotIn(Decimal("1.00"), self.get_prices().values())
+
+    def test_percent_of_the_filtered_products(self):
+        capped = self.products[9]
+        Product.objects.filter(pk=capped.pk).update(price=Decimal("9500.00"))
+        prices = self.get_prices()
+
+        response, bump = self.patch({"filter": {"price_min": "105"}, "percent": "33.33"})
+
+        self.assertEqual(response.data, {"updated": 5})
+        bump.assert_called_once_with()
+        expected = {
+            pk: price
+            if price < 105
+            else min(round(price * Decimal("1.3333"), 2), Decimal("9999.99"))
+            for pk, price in prices.items()
+        }
+        self.assertEqual(self.get_prices(), expected)
+        self.assertEqual(self.get_prices()[capped.pk], Decimal("9999.99"))
+
+    def test_percent_requires_a_filter(self):
+        prices = self.get_prices()
+
+        response, _ = self.patch({"percent": "10"})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.get_prices(), prices)
+
+        response, _ = self.patch({"filter": {}, "percent": "10"})
+
+        self.assertEqual(response.data, {"updated": 10})
+
+
+class CatalogueValidatorsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.products = create_products(15)
+        Product.objects.update(updated_at=timezone.now() - timedelta(hours=1))
+
+    def setUp(self):
+        cache.clear()
+
+    def test_pages_share_the_validators_aggregate(self):
+        with CaptureQueriesContext(connection) as queries:
+            first_page = self.client.get(reverse("products"), {"pagination": "cursor"})
+            self.client.get(first_page.data["next"])
+
+        self.assertEqual(len(get_product_queries(queries, "MAX(")), 1)
+        self.assertEqual(get_product_queries(queries, "COUNT("), [])
+
+    def test_not_modified(self):
+        response = self.client.get(reverse("products"))
+
+        response = self.client.get(reverse("products"), HTTP_IF_NONE_MATCH=response["ETag"])
+
+        self.assertEqual(response.status_code, 304)
+
+    def test_deleted_product_changes_the_validators(self):
+        response = self.client.get(reverse("products"))
+        etag, last_modified = response["ETag"], response["Last-Modified"]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.products[0].delete()
+
+        response = self.client.get(reverse("products"), HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(response.data["count"], 14)
+
+
+class CatalogueCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.products = create_products(5)
+        cls.admin = User.objects.create_superuser(email="admin@mail.com", password="admin")
+
+    def setUp(self):
+        cache.clear()
+
+    def get_names(self):
+        return [
+            product["name"] for product in self.client.get(reverse("products")).data["results"]
+        ]
+
+    def test_hit_makes_no_queries_and_reads_the_version_once(self):
+        self.client.get(reverse("products"), {"facets": "1"})
+
+        with mock.patch(
+            "ecommerce.api.mixins.get_catalogue_state", wraps=get_catalogue_state
+        ) as get_state, self.assertNumQueries(0):
+            response = self.client.get(reverse("products"), {"facets": "1"})
+
+        self.assertEqual(response.status_code, 200)
+        get_state.assert_called_once_with()
+
+    def test_save_invalidates(self):
+        self.get_names()
+
+        product = Product.objects.get(pk=self.products[0].pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            product.name = "Renamed"
+            product.save()
+
+        self.assertIn("Renamed", self.get_names())
+
+    def test_delete_invalidates(self):
+        self.get_names()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.products[0].delete()
+
+        self.assertNotIn(self.products[0].name, self.get_names())
+
+    def test_admin_change_invalidates(self):
+        category = self.products[0].category
+        self.client.get(reverse("products"))
+        self.client.force_login(self.admin)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse("admin:ecommerce_productcategory_change", args=[category.pk]),
+                {"name": "Laptops"},
+            )
+
+        self.assertEqual(response.status_code, 302)
+        response = self.client.get(reverse("products"))
+        self.assertEqual(response.data["results"][0]["category"]["name"], "Laptops")
+
+    def test_admin_action_invalidates(self):
+        Product.objects.update(image_min_status=ImageStatus.READY)
+        self.client.get(reverse("products"))
+        self.client.force_login(self.admin)
+
+        with mock.patch("ecommerce.admin.create_image_min.delay"):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(
+                    reverse("admin:ecommerce_product_changelist"),
+                    {
+                        "action": "regenerate_image_min",
+                        "_selected_action": [product.pk for product in self.products],
+                    },
+                )
+
+        response = self.client.get(reverse("products"))
+        self.assertEqual(
+            {product["image_min_status"] for product in response.data["results"]},
+            {ImageStatus.PENDING},
+        )
+
+
+class CatalogueBuildLockTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_concurrent_misses_build_once(self):
+        builds = []
+
+        def build():
+            builds.append(1)
+            time.sleep(0.2)
+            return "value"
+
+        with ThreadPoolExecutor(10) as executor:
+            values = list(executor.map(lambda _: get_or_build("test:key", build), range(10)))
+
+        self.assertEqual(values, ["value"] * 10)
+        self.assertEqual(len(builds), 1)
+
+    def test_waiters_build_when_the_builder_fails(self):
+        def fail():
+            time.sleep(0.2)
+            raise ValueError
+
+        with ThreadPoolExecutor(2) as executor:
+            failing = executor.submit(get_or_build, "test:key", fail)
+            time.sleep(0.05)
+            waiting = executor.submit(get_or_build, "test:key", lambda: "value")
+
+            self.assertEqual(waiting.result(), "value")
+            with self.assertRaises(ValueError):
+                failing.result()
+
+
+class OrderCreateTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = User.objects.create_user(email="customer@mail.com", role=Role.CUSTOMER)
+        cls.products = create_products(500)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.customer)
+
+    def post_order(self, products, full_name="John Doe"):
+        data = {
+            "items": [{"product": product.pk, "quantity": 2} for product in products],
+            "shipping_address": {
+                "full_name": full_name,
+                "street": "Main Street 1",
+                "zip_code": "00-001",
+                "city": "Warsaw",
+                "country": "PL",
+            },
+        }
+        return self.client.post(reverse("orders"), data, format="json")
+
+    def test_query_count_does_not_depend_on_item_count(self):
+        query_counts = {}
+        for count in (1, 10, 500):
+            with CaptureQueriesContext(connection) as queries:
+                # a new address each time, so that every order takes the same path
+                response = self.post_order(self.products[:count], full_name=f"Customer {count}")
+
+            self.assertEqual(response.status_code, 201, response.data)
+            query_counts[count] = len(queries)
+
+        self.assertEqual(len(set(query_counts.values())), 1, query_counts)
+        self.assertEqual(OrderItem.objects.count(), 511)
+
+    def test_invalid_product_ids_are_reported_together(self):
+        products = self.products[:2] + [Product(pk=999999), Product(pk=999998)]
+
+        response = self.post_order(products)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data["items"], ["Invalid product ids: 999998, 999999."])
+        self.assertFalse(Order.objects.exists())
+
+
+class OrderHistoryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = User.objects.create_user(email="customer@mail.com", role=Role.CUSTOMER)
+        cls.other = User.objects.create_user(email="other@mail.com", role=Role.CUSTOMER)
+        cls.products = create_products(3)
+        cls.orders = [create_order(cls.customer, cls.products) for _ in range(15)]
+        cls.other_order = create_order(cls.other, cls.products)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.customer)
+
+    def get(self, url, params=None, queries=2):
+        with self.assertNumQueries(queries):
+            response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_list_pages_in_two_queries(self):
+        first = self.get(reverse("orders"))
+        second = self.get(first["next"])
+
+        expected = [order.pk for order in reversed(self.orders)]
+        self.assertEqual([order["id"] for order in first["results"] + second["results"]], expected)
+        self.assertEqual([len(order["items"]) for order in first["results"]], [3] * 10)
+        self.assertIsNone(second["next"])
+
+    def test_list_has_no_count(self):
+        page = self.get(reverse("orders"), {"count": "estimate"})
+
+        self.assertNotIn("count", page)
+
+    def test_detail_in_two_queries(self):
+        order = self.get(reverse("order", args=[self.orders[0].pk]))
+
+        self.assertEqual(order["id"], self.orders[0].pk)
+        self.assertEqual(len(order["items"]), 3)
+
+    def test_detail_of_another_customer_is_not_found(self):
+        response = self.client.get(reverse("order", args=[self.other_order.pk]))
+
+        self.assertEqual(response.status_code, 404)
+
+
+@skipUnless(connection.vendor == "postgresql", "Row locking is tested on PostgreSQL.")
+class StockReservationTests(TransactionTestCase):
+    threads = 20
+
+    def setUp(self):
+        self.customer = User.objects.create_user(email="customer@mail.com", role=Role.CUSTOMER)
+        self.first, self.second = create_products(2, stock=10)
+
+    def post_order(self, index, items):
+        client = APIClient()
+        client.force_authenticate(self.customer)
+        data = {
+            "items": [{"product": product.pk, "quantity": 1} for product in items],
+            "shipping_address": {
+                "full_name": f"Customer {index}",
+                "street": "Main Street 1",
+                "zip_code": "00-001",
+                "city": "Warsaw",
+                "country": "PL",
+            },
+        }
+        try:
+            return client.post(reverse("orders"), data, format="json").status_code
+        finally:
+            connection.close()
+
+    def test_concurrent_orders_do_not_oversell_or_deadlock(self):
+        # half of the orders list the products the other way round
+        orders = [
+            [self.first, self.second] if i % 2 else [self.second, self.first]
+            for i in range(self.threads)
+        ]
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            statuses = list(executor.map(self.post_order, range(self.threads), orders))
+
+        self.assertEqual(statuses.count(201), 10)
+        self.assertEqual(statuses.count(400), self.threads - 10)
+        self.first.refresh_from_db()
+        self.second.refresh_from_db()
+        self.assertEqual((self.first.stock, self.second.stock), (0, 0))
+        self.assertEqual(Order.objects.count(), 10)
+        self.assertEqual(OrderItem.objects.count(), 20)
+
+
+class IdempotentOrderTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = User.objects.create_user(email="customer@mail.com", role=Role.CUSTOMER)
+        cls.product = create_products(1, stock=10)[0]
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.customer)
+
+    def post_order(self, key, quantity=1):
+        data = {
+            "items": [{"product": self.product.pk, "quantity": quantity}],
+            "shipping_address": {
+                "full_name": "John Doe",
+                "street": "Main Street 1",
+                "zip_code": "00-001",
+                "city": "Warsaw",
+                "country": "PL",
+            },
+        }
+        return self.client.post(reverse("orders"), data, format="json", HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retry_is_replayed(self):
+        first = self.post_order("key")
+        retry = self.post_order("key")
+
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual((retry.status_code, retry.data), (201, first.data))
+        self.assertEqual(retry["Idempotent-Replayed"], "true")
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_key_of_a_different_request_is_refused(self):
+        self.post_order("key")
+
+        response = self.post_order("key", quantity=2)
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_failed_request_is_processed_again(self):
+        Product.objects.filter(pk=self.product.pk).update(stock=0)
+        self.assertEqual(self.post_order("key").status_code, 400)
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+        Product.objects.filter(pk=self.product.pk).update(stock=10)
+        response = self.post_order("key")
+
+        self.assertEqual(response.status_code, 201)
+        self.assertNotIn("Idempotent-Replayed", response)
+
+    def test_expired_key_is_reused(self):
+        self.post_order("key")
+        IdempotencyKey.objects.update(
+            created_at=timezone.now() - timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL + 1)
+        )
+
+        response = self.post_order("key", quantity=2)
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Order.objects.count(), 2)
+        self.assertEqual(self.post_order("key", quantity=2)["Idempotent-Replayed"], "true")
+
+
+@skipUnless(connection.vendor == "postgresql", "Row locking is tested on PostgreSQL.")
+class ConcurrentIdempotentOrderTests(TransactionTestCase):
+    threads = 10
+
+    def setUp(self):
+        self.customer = User.objects.create_user(email="customer@mail.com", role=Role.CUSTOMER)
+        self.product = create_products(1, stock=10)[0]
+
+    def post_order(self, index):
+        client = APIClient()
+        client.force_authenticate(self.customer)
+        data = {
+            "items": [{"product": self.product.pk, "quantity": 1}],
+            "shipping_address": {
+                "full_name": "John Doe",
+                "street": "Main Street 1",
+                "zip_code": "00-001",
+                "city": "Warsaw",
+                "country": "PL",
+            },
+        }
+        try:
+            return client.post(reverse("orders"), data, format="json", HTTP_IDEMPOTENCY_KEY="key")
+        finally:
+            connection.close()
+
+    def test_concurrent_duplicates_create_one_order(self):
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            responses = list(executor.map(self.post_order, range(self.threads)))
+
+        self.assertEqual({response.status_code for response in responses}, {201})
+        self.assertEqual(len({response.data["payment_deadline"] for response in responses}), 1)
+        replayed = [response for response in responses if "Idempotent-Replayed" in response]
+        self.assertEqual(len(replayed), self.threads - 1)
+        self.assertEqual(Order.objects.count(), 1)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 9)
+
+
+class FakeSMTPConnection:
+    """
+    Refuses the given recipients, or drops the connection on the first send.
+    """
+
+    def __init__(self, refused=(), disconnected=False):
+        self.refused = refused
+        self.disconnected = disconnected
+        self.sent = []
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def send_messages(self, messages):
+        if self.disconnected:
+            self.disconnected = False
+            raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+        for message in messages:
+            if set(message.to) & set(self.refused):
+                raise smtplib.SMTPRecipientsRefused({message.to[0]: (550, b"No such user")})
+        self.sent += messages
+        return len(messages)
+
+
+class EmailDeliveryTests(SimpleTestCase):
+    def setUp(self):
+        delivery.close_connection()
+        self.addCleanup(delivery.close_connection)
+
+    def build_messages(self, recipients):
+        return delivery.build_messages("Subject", "Text", "<p>HTML</p>", recipients)
+
+    def test_batch_reuses_one_connection(self):
+        recipients = [f"customer{i}@mail.com" for i in range(20)]
+
+        with mock.patch.object(mail, "get_connection", wraps=mail.get_connection) as connect:
+            failed = delivery.send_messages(self.build_messages(recipients[:10]))
+            failed += delivery.send_messages(self.build_messages(recipients[10:]))
+
+        self.assertEqual(failed, [])
+        self.assertEqual(connect.call_count, 1)
+        self.assertEqual([message.to[0] for message in mail.outbox], recipients)
+
+    def test_refused_recipient_fails_only_its_message(self):
+        connection = FakeSMTPConnection(refused=["bad@mail.com"])
+        messages = self.build_messages(["first@mail.com", "bad@mail.com", "last@mail.com"])
+
+        with mock.patch.object(mail, "get_connection", return_value=connection):
+            failed = delivery.send_messages(messages)
+
+        self.assertEqual([message.to for message in failed], [["bad@mail.com"]])
+        self.assertEqual(
+            [message.to for message in connection.sent], [["first@mail.com"], ["last@mail.com"]]
+        )
+
+    def test_reconnects_once_when_disconnected(self):
+        dropped = FakeSMTPConnection(disconnected=True)
+        reconnected = FakeSMTPConnection()
+        messages = self.build_messages(["first@mail.com", "second@mail.com"])
+
+        with mock.patch.object(mail, "get_connection", side_effect=[dropped, reconnected]):
+            failed = delivery.send_messages(messages)
+
+        self.assertEqual(failed, [])
+        self.assertEqual(dropped.sent, [])
+        self.assertEqual(reconnected.sent, messages)
+
+    def test_gives_up_when_disconnected_again(self):
+        connections = [FakeSMTPConnection(disconnected=True) for _ in range(2)]
+        messages = self.build_messages(["first@mail.com", "second@mail.com"])
+
+        with mock.patch.object(mail, "get_connection", side_effect=connections):
+            failed = delivery.send_messages(messages)
+
+        # the first message fails after one reconnection, the next one is sent
+        self.assertEqual(failed, messages[:1])
+        self.assertEqual(connections[1].sent, messages[1:])
+
+    def test_benchmark_against_smtp_stand_in(self):
+        output = io.StringIO()
+
+        call_command("benchmark_email_delivery", count=20, connect_latency=0, stdout=output)
+
+        lines = output.getvalue().splitlines()
+        self.assertRegex(lines[0], r"^connection per email: \d+ emails/s$")
+        self.assertRegex(lines[1], r"^pooled connection: \d+ emails/s$")
+
+
+class OutboxTests(TestCase):
+    def enqueue(self, order_id, **kwargs):
+        outbox.enqueue(
+            tasks.send_order_email,
+            kwargs={"order_id": order_id, "template": "order_confirmation"},
+            dedupe_key=f"order-confirmation:{order_id}",
+            **kwargs,
+        )
+        return OutboxMessage.objects.get(dedupe_key=f"order-confirmation:{order_id}")
+
+    def test_duplicate_dedupe_key_is_ignored(self):
+        self.enqueue(1)
+        self.enqueue(1)
+
+        self.assertEqual(OutboxMessage.objects.count(), 1)
+
+    def test_relay_publishes_batches_once(self):
+        messages = [self.enqueue(order_id) for order_id in range(3)]
+        delayed = self.enqueue(3, eta=timezone.now() + timedelta(hours=1))
+
+        with mock.patch("ecommerce.outbox.app") as app:
+            self.assertEqual(outbox.relay(), 4)
+            self.assertEqual(outbox.relay(), 0)
+
+        batch_call, delayed_call = sorted(
+            app.send_task.call_args_list, key=lambda call: call.kwargs.get("eta") is not None
+        )
+        self.assertEqual(batch_call.args, ("ecommerce.tasks.send_order_emails",))
+        self.assertEqual(
+            [message["outbox_id"] for message in batch_call.kwargs["kwargs"]["messages"]],
+            [message.pk for message in messages],
+        )
+        self.assertEqual(delayed_call.args, ("ecommerce.tasks.send_order_email",))
+        self.assertEqual(delayed_call.kwargs["kwargs"]["outbox_id"], delayed.pk)
+        self.assertFalse(OutboxMessage.objects.filter(published_at__isnull=True).exists())
+
+    def test_duplicate_message_is_sent_once(self):
+        message = self.enqueue(1)
+        kwargs = message.kwargs | {"outbox_id": message.pk}
+
+        with mock.patch("ecommerce.tasks._deliver_order_emails", return_value=[]) as deliver:
+            tasks.send_order_email.apply(kwargs=kwargs)
+            duplicate = tasks.send_order_emails.apply(kwargs={"messages": [kwargs]})
+
+        self.assertEqual(duplicate.get(), "0 emails sent.")
+        self.assertEqual(
+            deliver.call_args_list[0],
+            mock.call([{"order_id": 1, "template": "order_confirmation"}]),
+        )
+        message.refresh_from_db()
+        self.assertIsNotNone(message.processed_at)
+
+    def test_unexpected_error_is_retried(self):
+        message = self.enqueue(1)
+
+        with mock.patch(
+            "ecommerce.tasks._deliver_order_emails", side_effect=[DatabaseError, []]
+        ) as deliver:
+            result = tasks.send_order_email.apply(
+                kwargs=message.kwargs | {"outbox_id": message.pk}
+            )
+
+        self.assertEqual(result.get(), "Email sent.")
+        self.assertEqual(deliver.call_count, 2)
+        message.refresh_from_db()
+        self.assertIsNotNone(message.processed_at)
+
+    def test_failed_batch_is_split_into_single_emails(self):
+        messages = [self.enqueue(order_id) for order_id in range(2)]
+        payloads = [message.kwargs | {"outbox_id": message.pk} for message in messages]
+
+        with mock.patch(
+            "ecommerce.tasks._deliver_order_emails", side_effect=DatabaseError
+        ), mock.patch.object(tasks.send_order_email, "apply_async") as apply_async:
+            tasks.send_order_emails.apply(kwargs={"messages": payloads})
+
+        self.assertEqual([call.kwargs["kwargs"] for call in apply_async.call_args_list], payloads)
+        self.assertFalse(OutboxMessage.objects.filter(processed_at__isnull=False).exists())
+
+
+class PaymentReminderTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = User.objects.create_user(email="customer@mail.com", role=Role.CUSTOMER)
+
+    def create_order(self, deadline_ago, **fields):
+        deadline = timezone.now() - timedelta(
+            seconds=settings.PAYMENT_REMINDER_DELAY + deadline_ago
+        )
+        return create_order(
+            self.customer,
+            created_at=deadline - timedelta(days=5),
+            payment_deadline=deadline,
+            **fields,
+        )
+
+    def get_reminders(self):
+        return list(
+            OutboxMessage.objects.filter(task=tasks.send_order_email.name)
+            .order_by("pk")
+            .values_list("kwargs", flat=True)
+        )
+
+    def test_due_unpaid_order_is_reminded_once(self):
+        order = self.create_order(deadline_ago=60)
+
+        self.assertEqual(tasks.send_payment_reminders(), "1 payment reminders sent.")
+        self.assertEqual(tasks.send_payment_reminders(), "0 payment reminders sent.")
+
+        self.assertEqual(
+            self.get_reminders(), [{"order_id": order.pk, "template": "payment_reminder"}]
+        )
+        order.refresh_from_db()
+        self.assertIsNotNone(order.reminder_sent_at)
+
+    def test_paid_and_not_yet_due_orders_are_skipped(self):
+        paid = self.create_order(deadline_ago=60, payment_status=PaymentStatus.PAID)
+        not_due = self.create_order(deadline_ago=-60)
+
+        self.assertEqual(tasks.send_payment_reminders(), "0 payment reminders sent.")
+
+        self.assertEqual(self.get_reminders(), [])
+        self.assertFalse(
+            Order.objects.filter(pk__in=[paid.pk, not_due.pk], reminder_sent_at__isnull=False)
+        )
+
+    @override_settings(PAYMENT_REMINDER_BATCH_SIZE=2)
+    def test_orders_are_reminded_in_batches(self):
+        orders = [self.create_order(deadline_ago=60 - i) for i in range(5)]
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(tasks.send_payment_reminders(), "5 payment reminders sent.")
+
+        self.assertEqual(
+            [reminder["order_id"] for reminder in self.get_reminders()],
+            [order.pk for order in orders],
+        )
+        # three batches of 2, 2 and 1 orders and the empty one ending the sweep
+        self.assertEqual(
+            len([query for query in queries if "FOR UPDATE SKIP LOCKED" in query["sql"]]), 4
+        )
+
+
+class PaymentReminderMigrationTests(TransactionTestCase):
+    before = [("ecommerce", "0012_outboxmessage")]
+    after = [("ecommerce", "0013_order_payment_status")]
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_existing_orders_are_not_reminded_again(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.before)
+        apps = executor.loader.project_state(self.before).apps
+
+        user = apps.get_model("core", "User").objects.create(email="customer@mail.com")
+        address = apps.get_model("ecommerce", "ShippingAddress").objects.create(
+            user=user,
+            full_name="John Doe",
+            street="Main Street 1",
+            zip_code="00-001",
+            city="Warsaw",
+            country="PL",
+        )
+        created_at = timezone.now() - timedelta(days=10)
+        order = apps.get_model("ecommerce", "Order").objects.create(
+            user=user,
+            shipping_address=address,
+            created_at=created_at,
+            payment_deadline=created_at + timedelta(days=5),
+        )
+
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.after)
+
+        order = Order.objects.get(pk=order.pk)
+        self.assertEqual(order.reminder_sent_at, created_at)
+        self.assertEqual(order.payment_status, PaymentStatus.UNPAID)
+        self.assertEqual(tasks.send_payment_reminders(), "0 payment reminders sent.")